@@ -0,0 +1,59 @@
+# Measures the cost of `import traffic` in a fresh interpreter, which every batch
+# worker pays, and checks that importing spawns no subprocesses.
+#
+#   python3 benchmarks/bench_import.py [--runs N]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+SPAWN_CHECK = """
+import sys
+spawned = []
+sys.addaudithook(lambda event, args: spawned.append(event) if event in
+                 ('subprocess.Popen', 'os.system', 'os.posix_spawn', 'os.exec', 'os.fork') else None)
+import traffic
+print(len(spawned))
+"""
+
+def time_command(code, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+def import_self_time():
+    # Self time of the traffic module itself, as reported by -X importtime (microseconds).
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import traffic'],
+                            cwd=ROOT, check=True, capture_output=True, text=True)
+    for line in result.stderr.splitlines():
+        parts = [p.strip() for p in line.split('|')]
+        if len(parts) == 3 and parts[2] == 'traffic':
+            return int(parts[0].split()[-1])
+    return None
+
+def bench_import(runs=20):
+    interpreter = time_command('pass', runs)
+    with_import = time_command('import traffic', runs)
+    spawned = subprocess.run([sys.executable, '-c', SPAWN_CHECK], cwd=ROOT, check=True,
+                             capture_output=True, text=True).stdout.strip()
+    return {
+        "interpreter_ms": interpreter * 1000,
+        "import_ms": (with_import - interpreter) * 1000,
+        "module_self_us": import_self_time(),
+        "subprocesses_spawned": int(spawned),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the import cost of traffic.py")
+    parser.add_argument('--runs', type=int, default=20, help='Interpreter launches per measurement.')
+    args = parser.parse_args()
+    print(json.dumps(bench_import(args.runs), indent=2))
@@ -0,0 +1,185 @@
+# Benchmarks for the simulation hot paths: stepping, spawning, rendering and whole
+# headless runs. Results are printed as JSON and compared against the committed
+# baseline.json; the exit status is 1 if anything regressed by more than the tolerance.
+# Raw rates depend on the machine, so each is also expressed relative to a fixed
+# pure-Python reference loop timed alongside it (and import time relative to starting
+# the interpreter), and only those ratios are compared. --quick timings are
+# shorter and noisier, so they are held to a looser tolerance.
+#
+#   python3 benchmarks/bench_traffic.py                  # run and compare with baseline.json
+#   python3 benchmarks/bench_traffic.py --quick          # shorter timings, for a smoke test
+#   python3 benchmarks/bench_traffic.py --save-baseline  # record a new baseline after a deliberate change
+
+import argparse
+import importlib.util
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(__file__))
+
+import traffic
+from bench_import import bench_import
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+CAR_COUNTS = (8, 16, 32) # the 21x21 grid saturates at a little over 30 cars
+LARGE = (40, 3, 300) # approach length, lanes and cars of a layout where the numpy engine pays off
+
+def rate(func, min_time):
+    # Calls per second over a run of at least min_time.
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time: return calls / elapsed
+
+def reference_loop():
+    # Fixed interpreter work of the kind a step does (tuple keys, dict lookups, small
+    # loops), whose rate is the unit results are compared in.
+    cells = {}
+    for i in range(200): cells[(i, i & 7)] = i
+    return sum(cells.get((i, i & 7), 0) for i in range(200))
+
+def measure(func, min_time, repeats=5):
+    # (best-of-repeats rate in calls per second, that rate in reference loops). Each
+    # repeat of func is followed by one of the reference loop, so both see the machine
+    # in the same state and the ratio holds across machines and background load.
+    best = reference = 0.0
+    for _ in range(repeats):
+        best = max(best, rate(func, min_time))
+        reference = max(reference, rate(reference_loop, min_time / 2))
+    return best, best / reference
+
+def busy_intersection(cars, engine='python', geometry=None, warmup=300):
+    # A warmed-up intersection under saturating demand, holding up to `cars` cars.
+    random.seed(0)
+    intersection = traffic.Intersection(cars, 10**9, traffic.SimpleIntersection, is_test_mode=True,
+                                        engine=engine, arrival_rate=4.0 if geometry is None else 8.0,
+                                        geometry=geometry)
+    for _ in range(warmup):
+        intersection.pattern.step()
+    assert not intersection.crash_detected
+    return intersection
+
+def bench_step(min_time):
+    results = {}
+    engines = ['python'] + (['numpy'] if importlib.util.find_spec('numpy') else [])
+    for engine in engines:
+        for cars in CAR_COUNTS:
+            intersection = busy_intersection(cars, engine)
+            results[f"step/{engine}/{cars}"] = measure(intersection.pattern.step, min_time)
+        length, lanes, cars = LARGE
+        intersection = busy_intersection(cars, engine, traffic.Geometry(length, lanes), warmup=600)
+        results[f"step/{engine}/large/{cars}"] = measure(intersection.pattern.step, min_time)
+    return results
+
+def bench_spawn_blocked(min_time):
+    # Every entry cell is taken and cars are queued on every approach, so each call has
+    # to try all the approaches and give up.
+    intersection = traffic.Intersection(100, 10**9, traffic.SimpleIntersection, is_test_mode=True, arrival_rate=1.0)
+    intersection.cars = [traffic.Car(i, d) for i, d in enumerate(traffic.DIRECTIONS)]
+    intersection.add_arrivals(traffic.DIRECTIONS * 1000)
+    return {"spawn_car/blocked": measure(intersection.spawn_car, min_time)}
+
+def bench_render(min_time):
+    # Output goes to a StringIO; frames cycle through a recorded run so every render
+    # has real differences to draw.
+    intersection = busy_intersection(32)
+    frames = []
+    for _ in range(60):
+        intersection.pattern.step()
+        frames.append(intersection.step_snapshot())
+    frames = itertools.cycle(frames)
+    renderer = traffic.TerminalRenderer(io.StringIO())
+    intersection.renderer = traffic.TerminalRenderer(io.StringIO())
+    def render():
+        renderer.stream.seek(0); renderer.stream.truncate()
+        renderer.render(next(frames))
+    def print_state():
+        intersection.renderer.stream.seek(0); intersection.renderer.stream.truncate()
+        intersection.print_state()
+    return {
+        "render/frame": measure(render, min_time),
+        "render/print_state": measure(print_state, min_time),
+        "render/update_grid": measure(intersection.update_grid, min_time),
+    }
+
+def bench_runs(min_time):
+    results = {}
+    seeds = iter(range(10**9))
+    for pattern in traffic.PATTERNS:
+        run = lambda: traffic.run_simulation(next(seeds), pattern=pattern, cars=50, turn_ratio=0.3)
+        results[f"run_simulation/{pattern}"] = measure(run, min_time)
+    return results
+
+def run_all(min_time, import_runs):
+    traffic.set_color_mode(False)
+    results = {}
+    for bench in (bench_step, bench_spawn_blocked, bench_render, bench_runs):
+        results.update({name: {"value": value, "unit": "ops/s", "higher_is_better": True, "relative": relative}
+                        for name, (value, relative) in bench(min_time).items()})
+    imported = bench_import(import_runs)
+    results["import/ms"] = {"value": imported["import_ms"], "unit": "ms", "higher_is_better": False,
+                            "relative": imported["import_ms"] / imported["interpreter_ms"]}
+    return results
+
+def compare(results, baseline, tolerance):
+    # Returns (name, baseline, current, relative change) for every regression, comparing
+    # the machine-independent "relative" figures. Results the baseline has no entry for
+    # are left without a "baseline" key.
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline: continue
+        old, new = baseline[name]["relative"], result["relative"]
+        change = (new - old) / old if old else 0.0
+        if not result["higher_is_better"]: change = -change
+        result["baseline"] = old
+        result["change"] = change
+        if change < -tolerance:
+            regressions.append((name, old, new, change))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark traffic.py hot paths")
+    parser.add_argument('--quick', action='store_true', help='Shorter timings (less stable).')
+    parser.add_argument('--output', '-o', type=str, default=None, help='Also write the results JSON to this file.')
+    parser.add_argument('--baseline', type=str, default=BASELINE, help='Baseline results to compare against.')
+    parser.add_argument('--save-baseline', action='store_true', help='Store these results as the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=None, help='Allowed slowdown before failing (fraction; default: 0.25, or 0.5 with --quick).')
+    args = parser.parse_args()
+    tolerance = args.tolerance if args.tolerance is not None else 0.5 if args.quick else 0.25
+
+    results = run_all(0.05 if args.quick else 0.3, 3 if args.quick else 20)
+    regressions, baseline = [], None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f: baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, tolerance)
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+        "regressions": [name for name, *_ in regressions],
+        "not_in_baseline": sorted(set(results) - set(baseline)) if baseline is not None else [],
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f: f.write(text + "\n")
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f: f.write(text + "\n")
+    if baseline is None and not args.save_baseline:
+        print(f"No baseline at {args.baseline}; record one with --save-baseline.", file=sys.stderr)
+    elif report["not_in_baseline"]:
+        print(f"Not in the baseline (re-record it with --save-baseline): {', '.join(report['not_in_baseline'])}", file=sys.stderr)
+    for name, old, new, change in regressions:
+        print(f"REGRESSION {name}: {old:.4g} -> {new:.4g} relative to the reference ({change:+.0%})", file=sys.stderr)
+    sys.exit(1 if regressions else 0)
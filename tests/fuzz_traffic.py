@@ -0,0 +1,196 @@
+# Randomized invariant fuzzing for the simulator. Each seed generates a scenario
+# (pattern, demand, layout, cars placed by hand, number of steps) that is run headless
+# with invariants checked after every step:
+#
+#   shared-cell     no two cars are on the same cell
+#   conservation    cars placed + cars created == cars passed + cars on the grid
+#   occupancy       the cell index matches the cars
+#   red-light       no car leaves its stop line on a light it must stop for
+#   plan            the lights are the ones the timing plan (or actuated phase) calls for
+#   engine-parity   with --compare, another engine produces the same run as the reference
+#
+# Scenarios run across a process pool. A failing scenario is shrunk to a minimal one
+# that still fails the same way and saved as JSON, which --replay runs again.
+#
+#   python3 tests/fuzz_traffic.py --runs 5000                # fuzz seeds 0..4999
+#   python3 tests/fuzz_traffic.py --runs 5000 --compare numpy
+#   python3 tests/fuzz_traffic.py --replay fuzz_failures/plan-123.json
+
+import argparse
+import json
+import os
+import random
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+import traffic
+
+def generate(seed):
+    # A scenario is plain data, so it can be shrunk, saved and replayed.
+    rng = random.Random(seed)
+    approach_length, lanes = rng.randint(5, 12), rng.randint(1, 3)
+    geometry = traffic.Geometry(approach_length, lanes)
+    placements, taken = [], set()
+    for _ in range(rng.randint(0, 6)):
+        direction, turn, lane = rng.choice(traffic.DIRECTIONS), rng.choice([None, "left"]), rng.randrange(lanes)
+        route, _ = geometry.route(direction, turn, *geometry.entry_cells[direction][lane])
+        index = rng.randrange(len(route.cells) - 1)
+        if route.cells[index] in taken: continue
+        taken.add(route.cells[index])
+        placements.append([direction, turn, lane, index])
+    return {
+        "seed": seed,
+        "pattern": rng.choice(list(traffic.PATTERNS)),
+        "turn_ratio": rng.choice([0.0, rng.random()]),
+        "distribution": rng.choice([1.0, rng.random()]),
+        "arrival_rate": rng.choice([None, round(rng.uniform(0.05, 2.0), 2)]),
+        "concurrent_cars": rng.randint(1, 30),
+        "ignore_crashes": rng.random() < 0.5,
+        "approach_length": approach_length,
+        "lanes": lanes,
+        "placements": placements,
+        "steps": rng.randint(20, 400),
+    }
+
+def build(scenario, engine='python'):
+    geometry = traffic.Geometry(scenario["approach_length"], scenario["lanes"])
+    intersection = traffic.Intersection(scenario["concurrent_cars"], None, traffic.PATTERNS[scenario["pattern"]],
+                                        is_test_mode=True, seed=scenario["seed"], left_turn_percentage=scenario["turn_ratio"],
+                                        distribution_factor=scenario["distribution"], ignore_crashes=scenario["ignore_crashes"],
+                                        engine=engine, arrival_rate=scenario["arrival_rate"], geometry=geometry, max_steps=None)
+    cars = []
+    for i, (direction, turn, lane, index) in enumerate(scenario["placements"]):
+        car = traffic.Car(10**6 + i, direction, turn, lane, geometry) # ids apart from spawned cars
+        for _ in range(index): car.move()
+        cars.append(car)
+    intersection.cars = cars
+    return intersection
+
+def check_step(intersection, before, phase, placed):
+    # Returns (invariant, detail) for the first invariant broken by the last step, or None.
+    cars = intersection.cars
+    cells = {(car.x, car.y) for car in cars}
+    if len(cells) != len(cars):
+        return "shared-cell", f"{len(cars)} cars on {len(cells)} cells"
+    if placed + intersection.cars_created != intersection.passed_cars + len(cars):
+        return "conservation", f"{placed} placed + {intersection.cars_created} created != {intersection.passed_cars} passed + {len(cars)} on grid"
+    occupancy = intersection._occupancy # a dict, or the numpy engine standing in for one
+    if len(occupancy) != len(cars) or any(occupancy.get((car.x, car.y)) is not car for car in cars):
+        return "occupancy", "cell index out of step with the cars"
+    lights = intersection.pattern.lights
+    for car, route, pos in before:
+        if pos == route.stop and car.route is route and car.pos > pos and lights[route.approach] in route.halts:
+            return "red-light", f"car {car.id} left the {route.approach} stop line on {lights[route.approach].name}"
+    pattern = intersection.pattern
+    if isinstance(pattern, traffic.ActuatedIntersection):
+        phases = len(pattern.plan.phases)
+        if pattern.phase not in (phase, (phase + 1) % phases) or lights != pattern.plan.phases[pattern.phase][0]:
+            return "plan", f"phase {phase} -> {pattern.phase} with lights {lights}"
+    elif lights != pattern.plan.lights_at(intersection.steps - 1):
+        return "plan", f"lights at step {intersection.steps} are not the plan's"
+    return None
+
+def run_scenario(scenario, engine='python'):
+    # Runs a scenario, checking every step. Returns (failure or None, per-step states).
+    intersection = build(scenario, engine)
+    placed = len(intersection.cars)
+    states = []
+    for _ in range(scenario["steps"]):
+        before = [(car, car.route, car.pos) for car in intersection.cars]
+        phase = getattr(intersection.pattern, "phase", None)
+        intersection.pattern.step()
+        states.append(tuple((car.id, car.x, car.y, car.direction, car.turn, car.stopped) for car in intersection.cars))
+        broken = check_step(intersection, before, phase, placed)
+        if broken:
+            return {"invariant": broken[0], "detail": broken[1], "step": intersection.steps, "engine": engine}, states
+    return None, states
+
+def check(scenario, compare=None):
+    failure, states = run_scenario(scenario)
+    if failure or compare is None: return failure
+    failure, other = run_scenario(scenario, compare)
+    if failure: return failure
+    for step, (expected, got) in enumerate(zip(states, other), 1):
+        if expected != got:
+            return {"invariant": "engine-parity", "detail": f"{compare} differs from python", "step": step, "engine": compare}
+    return None
+
+def shrink(scenario, fails):
+    # Greedily simplifies a failing scenario while fails(candidate) still holds: fewer
+    # steps, fewer placed cars, less and simpler demand, a smaller layout.
+    def candidates(s):
+        if s["steps"] > 1:
+            yield dict(s, steps=s["steps"] // 2)
+            yield dict(s, steps=s["steps"] - 1)
+        for i in range(len(s["placements"])):
+            yield dict(s, placements=s["placements"][:i] + s["placements"][i + 1:])
+        if s["concurrent_cars"] > 0: yield dict(s, concurrent_cars=s["concurrent_cars"] // 2)
+        for key, simple in (("turn_ratio", 0.0), ("distribution", 1.0), ("ignore_crashes", False), ("pattern", "simple")):
+            if s[key] != simple: yield dict(s, **{key: simple})
+        if s["lanes"] > 1 and all(lane == 0 for _, _, lane, _ in s["placements"]): yield dict(s, lanes=1)
+        if s["approach_length"] > 5 and not s["placements"]: yield dict(s, approach_length=5)
+    improved = True
+    while improved:
+        improved = False
+        for candidate in candidates(scenario):
+            if fails(candidate):
+                scenario, improved = candidate, True
+                break
+    return scenario
+
+def fuzz_seed(seed, compare=None):
+    # Worker entry point: (seed, None) or (seed, minimal failing scenario with its failure).
+    traffic.set_color_mode(False)
+    scenario = generate(seed)
+    failure = check(scenario, compare)
+    if failure is None: return seed, None
+    same = lambda candidate: (check(candidate, compare) or {}).get("invariant") == failure["invariant"]
+    scenario = shrink(scenario, same)
+    return seed, dict(scenario, failure=check(scenario, compare))
+
+def fuzz(seeds, workers=None, compare=None):
+    # Yields (seed, failure) as scenarios finish, unordered when run in parallel.
+    import functools
+    job = functools.partial(fuzz_seed, compare=compare)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        yield from map(job, seeds)
+        return
+    import multiprocessing
+    with multiprocessing.Pool(workers) as pool:
+        yield from pool.imap_unordered(job, seeds, chunksize=16)
+
+def save(reproducer, directory):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{reproducer['failure']['invariant']}-{reproducer['seed']}.json")
+    with open(path, 'w') as f: json.dump(reproducer, f, indent=2)
+    return path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fuzz traffic.py against its invariants")
+    parser.add_argument('--runs', '-n', type=int, default=1000, help='Scenarios to generate.')
+    parser.add_argument('--seed', '-s', type=int, default=0, help='First seed; scenario i uses seed + i.')
+    parser.add_argument('--workers', '-w', type=int, default=None, help='Worker processes (default: all cores).')
+    parser.add_argument('--compare', type=str, default=None, choices=[e for e in traffic.ENGINES if e != 'python'], help='Also run every scenario on this engine and compare it with the reference.')
+    parser.add_argument('--save-dir', type=str, default=os.path.join(ROOT, 'fuzz_failures'), help='Where minimal failing scenarios are written.')
+    parser.add_argument('--replay', type=str, default=None, help='Run a saved scenario and report how it fails.')
+    args = parser.parse_args()
+
+    if args.replay:
+        with open(args.replay) as f: scenario = json.load(f)
+        engine = scenario.get("failure", {}).get("engine")
+        failure = check(scenario, args.compare or (engine if engine != 'python' else None))
+        print(json.dumps(failure or "passes", indent=2))
+        sys.exit(1 if failure else 0)
+
+    failures = 0
+    for done, (seed, reproducer) in enumerate(fuzz(range(args.seed, args.seed + args.runs), args.workers, args.compare), 1):
+        if reproducer:
+            failures += 1
+            failure = reproducer["failure"]
+            print(f"seed {seed}: {failure['invariant']} at step {failure['step']} ({failure['detail']}) -> {save(reproducer, args.save_dir)}")
+        if done % 500 == 0: print(f"{done}/{args.runs} scenarios, {failures} failing", file=sys.stderr)
+    print(f"{args.runs} scenarios, {failures} failing")
+    sys.exit(1 if failures else 0)
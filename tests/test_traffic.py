@@ -2,11 +2,24 @@ import unittest
 import sys
 import os
 import io
+import random
+import importlib.util
+import re
+import time
+import subprocess
+import json
+import tempfile
 
 # Add the parent directory to the path so we can import the traffic module
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from traffic import (Car, Intersection, SimpleIntersection, ProtectedLeftTurn, Light, 
+from traffic import (Car, Intersection, SimpleIntersection, ProtectedLeftTurn, Light,
+                     run_simulation, run_batch, BatchSummary, TerminalRenderer,
+                     Color, LIGHT_SYMBOL, set_color_mode, RoadNetwork, TimingPlan,
+                     FastForward, RealTime, unpaced, ArrivalProcess, ENTRY_CELLS,
+                     DEFAULT_GEOMETRY, Metrics, JsonlSink, CsvSink, TraceWriter, TraceReader, first_difference,
+                     PlanOptimizer, EvaluationCache, ActuatedIntersection, Geometry,
+                     RunningStats, P2Quantile, BatchMeans, SteadyState, run_long,
                      LANE_N_X, LANE_S_X, LANE_E_Y, LANE_W_Y,
                      INTERSECTION_START_Y, INTERSECTION_END_Y,
                      INTERSECTION_START_X, INTERSECTION_END_X)
@@ -39,6 +52,47 @@ class TestIntersection(unittest.TestCase):
         intersection.spawn_car() # Should not spawn more than concurrent_cars
         self.assertEqual(len(intersection.cars), 1)
 
+    def test_occupancy_index_tracks_moves_and_exits(self):
+        intersection = Intersection(20, 100, SimpleIntersection, is_test_mode=True, ignore_crashes=True)
+        for _ in range(60):
+            intersection.steps += 1
+            intersection.update_cars()
+            expected = {(car.x, car.y): car for car in intersection.cars}
+            self.assertEqual(intersection._occupancy, expected)
+        for car in intersection.cars:
+            self.assertIs(intersection.get_car_at(car.x, car.y), car)
+
+    def test_blocked_approach_keeps_its_queue(self):
+        intersection = Intersection(5, 10**9, SimpleIntersection, is_test_mode=True, arrival_rate=1.0)
+        intersection.cars = [Car(0, "north")]
+        intersection.add_arrivals(["north", "north", "east"])
+        intersection.spawn_car()
+        self.assertEqual(intersection.pending["north"], 2)
+        self.assertEqual(intersection.pending["east"], 0)
+        self.assertIs(intersection.get_car_at(*ENTRY_CELLS["east"]), intersection.cars[-1])
+
+
+class TestArrivals(unittest.TestCase):
+    def test_shares_follow_distribution(self):
+        random.seed(1)
+        even = ArrivalProcess(["north", "south", "east", "west"], 1.0)
+        self.assertEqual(even.shares, [0.25] * 4)
+        skewed = ArrivalProcess(["north", "south", "east", "west"], 0.2, total=1000)
+        self.assertAlmostEqual(sum(skewed.shares), 1.0)
+        self.assertAlmostEqual(max(skewed.shares), 0.85)
+        drawn = [skewed.next() for _ in range(1001)]
+        self.assertIsNone(drawn[-1])
+        heavy = skewed.approaches[skewed.shares.index(max(skewed.shares))]
+        self.assertGreater(drawn.count(heavy), 700)
+
+    def test_poisson_rate(self):
+        random.seed(2)
+        process = ArrivalProcess(["north", "south", "east", "west"], 1.0, rate=0.4)
+        total = sum(len(process.step()) for _ in range(5000))
+        self.assertAlmostEqual(total / 5000, 0.4, delta=0.05)
+        capped = ArrivalProcess(["north", "south"], 1.0, rate=5.0, total=7)
+        self.assertEqual(sum(len(capped.step()) for _ in range(10)), 7)
+
 
 class TestTrafficPatterns(unittest.TestCase):
     def test_simple_intersection_cycle(self):
@@ -48,6 +102,137 @@ class TestTrafficPatterns(unittest.TestCase):
         intersection.pattern.cycle()
         self.assertNotEqual(initial_lights, intersection.pattern.lights)
 
+    def test_plan_table_matches_phases(self):
+        plan = ProtectedLeftTurn.PLAN
+        step = 0
+        for lights, duration in plan.phases:
+            for _ in range(duration):
+                self.assertIs(plan.lights_at(step), lights)
+                self.assertIs(plan.lights_at(step + plan.cycle_length), lights)
+                step += 1
+        shifted = TimingPlan(plan.phases, offset=5)
+        self.assertEqual(shifted.lights_at(0), plan.phases[1][0])
+
+    def test_plan_round_trip_and_validation(self):
+        plan = SimpleIntersection.PLAN.with_durations([12, 3, 2, 8, 3, 2], offset=4)
+        copy = TimingPlan.from_dict(plan.to_dict())
+        self.assertEqual((copy.phases, copy.offset), (plan.phases, plan.offset))
+        self.assertEqual(copy.cycle_length, 30)
+        with self.assertRaises(ValueError):
+            TimingPlan([({"north": Light.GREEN}, 5)])
+        with self.assertRaises(ValueError):
+            TimingPlan.from_dict({"phases": [{"lights": {"north": "BLUE"}, "duration": 1}]})
+
+    def test_cycle_resumes_mid_cycle(self):
+        intersection = Intersection(1, 100, SimpleIntersection, is_test_mode=True)
+        for _ in range(12):
+            intersection.pattern.step()
+        self.assertEqual(intersection.pattern.lights["north"], Light.YELLOW)
+        intersection.pattern.cycle()
+        self.assertEqual(intersection.steps, 30)
+        intersection.pattern.cycle()
+        self.assertEqual(intersection.steps, 60)
+
+class TestGeometry(unittest.TestCase):
+    def test_default_matches_module_constants(self):
+        geometry = Geometry()
+        self.assertEqual((geometry.width, geometry.start_x, geometry.end_y), (21, INTERSECTION_START_X, INTERSECTION_END_Y))
+        self.assertEqual({d: cells[0] for d, cells in geometry.entry_cells.items()}, ENTRY_CELLS)
+        self.assertEqual(geometry.road_glyph(LANE_N_X, 0), "║")
+        self.assertEqual(geometry.road_glyph(LANE_S_X, LANE_E_Y), "╬")
+
+    def test_multi_lane_approaches(self):
+        geometry = Geometry(approach_length=15, lanes=3)
+        intersection = Intersection(40, 200, SimpleIntersection, is_test_mode=True, seed=4, arrival_rate=1.5, geometry=geometry)
+        lanes_used = set()
+        for _ in range(120):
+            intersection.pattern.step()
+            lanes_used.update((car.origin, car.x) for car in intersection.cars if car.direction == car.origin == "north")
+            for car in intersection.cars: self.assertTrue(geometry.contains(car.x, car.y))
+        self.assertEqual(len(lanes_used), 3)
+        self.assertEqual(intersection.crashes, 0)
+        self.assertGreater(intersection.passed_cars, 50)
+        self.assertEqual(len(geometry.approach_cells), 4 * 3 * 15)
+
+    def test_multi_lane_runs_finish_like_one_lane(self):
+        for pattern in ("simple", "actuated"):
+            finished = {}
+            for lanes in (1, 2, 3):
+                results = [run_simulation(seed, pattern, cars=40, geometry=Geometry(12, lanes)) for seed in range(10)]
+                self.assertEqual([r["crashes"] for r in results], [0] * 10)
+                finished[lanes] = sum(r["passed_cars"] >= r["goal_cars"] for r in results)
+            self.assertGreaterEqual(min(finished[2], finished[3]), finished[1] - 1, (pattern, finished))
+
+    def test_look_ahead_follows_the_heading(self):
+        self.assertEqual(Car(0, "east").route.buffers[0], (2, LANE_W_Y))
+        geometry = Geometry(approach_length=12)
+        x, y = geometry.entry_cells["east"][0]
+        self.assertEqual(Car(0, "east", geometry=geometry).route.buffers[0], (x + 2, y))
+        sideways = Geometry(heading_look_ahead=False) # the original rule
+        self.assertEqual(Car(0, "east", geometry=sideways).route.buffers[0], (0, LANE_W_Y + 2))
+        self.assertNotEqual(sideways, Geometry())
+        self.assertEqual(repr(sideways), "Geometry(approach_length=9, lanes=1, heading_look_ahead=False)")
+
+    def test_clearance_scales_with_the_junction(self):
+        geometry = Geometry(lanes=3)
+        intersection = Intersection(5, 10, SimpleIntersection, is_test_mode=True, geometry=geometry)
+        self.assertEqual(intersection.pattern.plan.clearance(), geometry.clearance)
+        self.assertIs(Intersection(5, 10, SimpleIntersection, is_test_mode=True).pattern.plan, SimpleIntersection.PLAN)
+        with self.assertRaises(ValueError):
+            Intersection(5, 10, SimpleIntersection, is_test_mode=True, geometry=geometry, timing_plan=SimpleIntersection.PLAN)
+        short = SimpleIntersection.PLAN.with_durations((10, 2, 1, 10, 2, 1)) # one-lane plans are taken as written
+        self.assertIs(Intersection(5, 10, SimpleIntersection, is_test_mode=True, timing_plan=short).pattern.plan, short)
+
+class TestRoutes(unittest.TestCase):
+    def test_left_turn_route(self):
+        car = Car(0, "north", "left")
+        route = car.route
+        self.assertEqual(route.cells[route.stop], (LANE_N_X, INTERSECTION_END_Y + 1))
+        turn = route.headings.index("west")
+        self.assertEqual(route.cells[turn], (LANE_N_X, LANE_E_Y))
+        self.assertEqual(route.turns[turn - 1:turn + 1], ["left", None])
+        self.assertTrue(all(Geometry().in_junction(*route.cells[i]) for i in route.zone))
+        self.assertEqual(route.cells[-1], (-1, LANE_E_Y))
+        while car.pos < turn: car.move()
+        self.assertEqual((car.x, car.y, car.direction, car.turn), (LANE_N_X, LANE_E_Y, "west", None))
+
+    def test_cars_placed_by_hand_are_put_on_a_route(self):
+        intersection = Intersection(5, 10, SimpleIntersection, is_test_mode=True)
+        car = Car(0, "east"); car.x, car.y = LANE_N_X - 1, LANE_E_Y
+        intersection.cars = [car]
+        self.assertEqual(car.route.cells[car.pos], (LANE_N_X - 1, LANE_E_Y))
+        intersection.update_cars()
+        self.assertEqual((car.x, car.y), (LANE_N_X, LANE_E_Y))
+
+class TestActuated(unittest.TestCase):
+    def test_detectors_match_a_scan(self):
+        intersection = Intersection(15, 60, ActuatedIntersection, is_test_mode=True, distribution_factor=0.3,
+                                    ignore_crashes=True, seed=2, arrival_rate=0.6)
+        for _ in range(150):
+            intersection.pattern.step()
+            for approach in ENTRY_CELLS:
+                on_lane = [car for car in intersection.cars if intersection.geometry.approach_cells.get((car.x, car.y)) == approach]
+                self.assertEqual(intersection.approach_count(approach), len(on_lane))
+                self.assertEqual(intersection.queue_length(approach), sum(car.stopped for car in on_lane))
+
+    def test_rests_in_green_without_conflicting_demand(self):
+        intersection = Intersection(5, 100, ActuatedIntersection, is_test_mode=True, approaches=["north"], seed=0)
+        for _ in range(60): intersection.pattern.step()
+        self.assertEqual(intersection.pattern.lights["north"], Light.GREEN)
+
+    def test_gaps_out_to_serve_waiting_approach(self):
+        intersection = Intersection(5, 100, ActuatedIntersection, is_test_mode=True, approaches=["east"], seed=0)
+        for _ in range(20): intersection.pattern.step()
+        self.assertEqual(intersection.pattern.lights["east"], Light.GREEN)
+        self.assertEqual(intersection.pattern.lights["north"], Light.RED)
+
+    def test_beats_fixed_time_on_skewed_demand(self):
+        fixed = BatchSummary(); actuated = BatchSummary()
+        for seed in range(10):
+            fixed.add(run_simulation(seed, pattern='simple', cars=30, distribution=0.1))
+            actuated.add(run_simulation(seed, pattern='actuated', cars=30, distribution=0.1))
+        self.assertGreater(actuated.report()["throughput"], fixed.report()["throughput"])
+
 class TestPositioning(unittest.TestCase):
     def test_car_initial_positions(self):
         self.assertEqual(Car(0, "north").x, LANE_N_X)
@@ -101,6 +286,514 @@ class TestCrashCondition(unittest.TestCase):
         intersection.spawn_car()
         self.assertEqual(len(intersection.cars), initial_car_count)
 
+    def test_conflicts_do_not_depend_on_car_order(self):
+        for order in (1, -1):
+            intersection = Intersection(10, 20, SimpleIntersection, is_test_mode=True)
+            car1 = Car(1, "north"); car1.y = LANE_E_Y + 1
+            car2 = Car(2, "east"); car2.x, car2.y = LANE_N_X - 1, LANE_E_Y
+            intersection.cars = [car1, car2][::order]
+            intersection.pattern.lights.update({'north': Light.GREEN, 'east': Light.GREEN})
+            intersection.update_cars()
+            self.assertEqual(intersection.crashes, 1)
+            self.assertEqual([(car1.x, car1.y, car1.stopped), (car2.x, car2.y, car2.stopped)],
+                             [(LANE_N_X, LANE_E_Y, False), (LANE_N_X - 1, LANE_E_Y, True)])
+
+    def test_conflict_matrix(self):
+        geometry = Geometry()
+        geometry.route("north", None, LANE_N_X, 20)
+        north = ((LANE_N_X, LANE_E_Y + 1), (LANE_N_X, LANE_E_Y))
+        self.assertIn(((LANE_N_X, LANE_E_Y), (LANE_N_X - 1, LANE_E_Y)), geometry.conflicts[north]) # crossing westbound
+        self.assertNotIn(((LANE_N_X, LANE_E_Y), (LANE_N_X, LANE_E_Y - 1)), geometry.conflicts[north]) # following
+        geometry.route("south", None, LANE_N_X, 5) # a wrong-way car
+        self.assertIn(((LANE_N_X, 6), (LANE_N_X, 5)), geometry.conflicts[((LANE_N_X, 5), (LANE_N_X, 6))]) # swap
+
+    def test_cars_off_the_routes_leave_the_shared_layout_alone(self):
+        Intersection(5, 10, SimpleIntersection, is_test_mode=True).cars = [Car(0, "north")] # builds the shared routes
+        routes, conflicts = len(DEFAULT_GEOMETRY.routes), sum(map(len, DEFAULT_GEOMETRY.conflicts.values()))
+        for engine in ('python', 'numpy') if importlib.util.find_spec("numpy") else ('python',):
+            intersection = Intersection(5, 10, SimpleIntersection, is_test_mode=True, engine=engine)
+            intersection.cars = [self.placed(1, "south", LANE_N_X, 5)] # a wrong-way car
+            for _ in range(3): intersection.pattern.step()
+            self.assertIsNot(intersection.geometry, DEFAULT_GEOMETRY)
+            self.assertEqual(intersection.geometry, DEFAULT_GEOMETRY)
+            self.assertEqual((len(DEFAULT_GEOMETRY.routes), sum(map(len, DEFAULT_GEOMETRY.conflicts.values()))), (routes, conflicts))
+        self.assertIs(Intersection(5, 10, SimpleIntersection, is_test_mode=True).geometry, DEFAULT_GEOMETRY)
+
+    def resolve(self, engine, cars, wanting):
+        # The engine's conflict resolution when `wanting` cars try their next move: the ids
+        # of the cars that move, and the crashes counted.
+        intersection = Intersection(10, 20, SimpleIntersection, is_test_mode=True, engine=engine)
+        intersection.cars = cars
+        if engine == 'python':
+            intended = {car: car.route.cells[car.pos + 1] if car in wanting else (car.x, car.y) for car in cars}
+            moved = intersection._resolve_moves(intended).values()
+        else:
+            import numpy
+            state = intersection._engine.state[:len(cars)]
+            accepted = intersection._engine.resolve(state[:, intersection._engine.K], numpy.array([car in wanting for car in cars]))
+            moved = [car for car, move in zip(cars, accepted) if move]
+        return sorted(car.id for car in moved), intersection.crashes
+
+    def placed(self, car_id, direction, x, y):
+        car = Car(car_id, direction); car.x, car.y = x, y
+        return car
+
+    def test_swaps_crossings_and_held_queues(self):
+        y = LANE_W_Y # the eastbound lane
+        cases = {
+            # head-on: an eastbound car and a wrong-way car trade cells
+            "swap": ([self.placed(1, "east", 3, y), self.placed(2, "west", 4, y)], [], 2),
+            # an eastbound car enters the cell a northbound car is turning out of
+            "crossing": ([self.placed(1, "east", LANE_N_X - 1, y), self.placed(2, "north", LANE_N_X, y)], [2], 1),
+            # the car behind one held back at a crossing is held too
+            "queue": ([self.placed(3, "east", LANE_N_X - 2, y), self.placed(1, "east", LANE_N_X - 1, y),
+                       self.placed(2, "north", LANE_N_X, y)], [2], 2),
+            # the car behind the loser of a same-cell conflict is held too
+            "same cell": ([self.placed(1, "north", LANE_N_X, LANE_E_Y + 1), self.placed(2, "east", LANE_N_X - 1, LANE_E_Y),
+                           self.placed(3, "east", LANE_N_X - 2, LANE_E_Y)], [1], 2),
+        }
+        engines = ('python', 'numpy') if importlib.util.find_spec("numpy") else ('python',)
+        for name, (cars, moved, crashes) in cases.items():
+            for engine in engines:
+                for order in (1, -1):
+                    self.assertEqual(self.resolve(engine, cars[::order], cars), (moved, crashes), (name, engine, order))
+
+class TestRun(unittest.TestCase):
+    def test_run_yields_a_snapshot_per_step(self):
+        random.seed(4)
+        intersection = Intersection(15, 30, ProtectedLeftTurn, is_test_mode=True, left_turn_percentage=0.3)
+        frames = list(intersection.run())
+        timed = [f for f in frames if not f.cleanup]
+        self.assertEqual([f.step for f in timed], list(range(1, len(timed) + 1)))
+        self.assertEqual(frames[-1].passed_cars, intersection.passed_cars)
+        self.assertEqual(frames[-1].cars, tuple((c.id, c.x, c.y, c.direction, c.stopped) for c in intersection.cars))
+        self.assertTrue(frames[-1].protected)
+
+    def test_pacers(self):
+        self.assertEqual(list(FastForward(3)(iter(range(10)))), [2, 5, 8])
+        self.assertEqual(list(unpaced(range(3))), [0, 1, 2])
+        shown = 0
+        for _ in RealTime(fps=1000)(iter(range(50))):
+            shown += 1
+            time.sleep(0.01) # a renderer far slower than the target frame rate
+        self.assertLess(shown, 25)
+
+
+class TestBatch(unittest.TestCase):
+    def test_run_simulation_is_reproducible(self):
+        first = run_simulation(7, pattern='protected-left', cars=10, turn_ratio=0.5)
+        second = run_simulation(7, pattern='protected-left', cars=10, turn_ratio=0.5)
+        self.assertEqual(first, second)
+        self.assertEqual(first["cars_created"], 10)
+
+    def test_batch_summary(self):
+        summary = BatchSummary()
+        for result in run_batch(4, workers=1, cars=8):
+            summary.add(result)
+        report = summary.report()
+        self.assertEqual(report["runs"], 4)
+        self.assertGreater(report["throughput"], 0)
+        self.assertEqual(sum(w["cars"] for w in report["wait"].values()), summary.total_passed)
+
+    def test_throughput_counts_cleanup_steps(self):
+        result = run_simulation(2, cars=40, max_steps=60) # stopped early, the cars on the grid leave in cleanup
+        self.assertGreater(result["cleanup_steps"], 0)
+        summary = BatchSummary()
+        summary.add(result)
+        self.assertAlmostEqual(summary.report()["throughput"], result["passed_cars"] / (result["steps"] + result["cleanup_steps"]))
+
+class TestLongRun(unittest.TestCase):
+    def test_streaming_estimators(self):
+        rng = random.Random(3)
+        values = [rng.expovariate(0.5) for _ in range(20000)]
+        stats = RunningStats()
+        median, p90 = P2Quantile(0.5), P2Quantile(0.9)
+        means = BatchMeans(batches=16)
+        for value in values:
+            stats.add(value); median.add(value); p90.add(value); means.add(value)
+        self.assertAlmostEqual(stats.mean, sum(values) / len(values))
+        self.assertAlmostEqual(stats.variance, sum((v - stats.mean) ** 2 for v in values) / (len(values) - 1))
+        self.assertAlmostEqual(median.value(), sorted(values)[10000], delta=0.05)
+        self.assertAlmostEqual(p90.value(), sorted(values)[18000], delta=0.1)
+        self.assertLess(len(means.sums), 32)
+        self.assertLess(abs(means.mean - 2.0), means.half_width(0.999))
+        self.assertIsNone(BatchMeans(batches=16).half_width())
+
+    def test_steps_past_the_default_limit(self):
+        intersection = Intersection(5, None, SimpleIntersection, is_test_mode=True, seed=0, arrival_rate=0.1,
+                                    ignore_crashes=True, max_steps=None)
+        for _ in range(500): intersection.pattern.step()
+        self.assertFalse(intersection.is_finished())
+
+    def test_long_run_reports(self):
+        reports = list(run_long(0, steps=3000, warmup=100, report_every=1000, pattern='protected-left', arrival_rate=0.05))
+        self.assertEqual([r["step"] for r in reports], [1000, 2000, 3000])
+        final = reports[-1]
+        self.assertEqual(final["steps"], 2900)
+        self.assertIsNotNone(final["throughput"]["ci"])
+        self.assertAlmostEqual(sum(a["mean"] for a in final["throughput"]["approaches"].values()), final["throughput"]["mean"])
+        self.assertLessEqual(final["wait"]["quantiles"]["p50"], final["wait"]["quantiles"]["p99"])
+        self.assertFalse(final["gridlock"])
+
+    def test_long_runs_reach_a_steady_state(self):
+        for pattern in ("simple", "actuated"):
+            final = list(run_long(0, steps=20000, warmup=500, report_every=20000, pattern=pattern, arrival_rate=0.1))[-1]
+            self.assertTrue(final["valid"], pattern)
+            self.assertEqual(final["step"], 20000)
+            self.assertAlmostEqual(final["throughput"]["mean"], 0.1, delta=0.01)
+
+    def test_stalled_steps_are_held_out_of_the_estimates(self):
+        stats = SteadyState()
+        intersection = Intersection(1, None, SimpleIntersection, is_test_mode=True, metrics=stats, max_steps=None)
+        car = Car(0, "east")
+        for _ in range(car.route.stop): car.move()
+        intersection.cars = [car]
+        for _ in range(10): intersection.pattern.step() # east is red
+        self.assertEqual((stats.stalled, stats.observed_steps), (10, 0))
+        while car.stopped: intersection.pattern.step()
+        self.assertEqual(stats.observed_steps, intersection.steps)
+
+class TestFuzz(unittest.TestCase):
+    def setUp(self):
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import fuzz_traffic
+        self.fuzz = fuzz_traffic
+
+    def test_scenarios_hold_the_invariants(self):
+        self.assertEqual([seed for seed, failure in self.fuzz.fuzz(range(20), workers=1) if failure], [])
+
+    def test_scenarios_are_replayable(self):
+        scenario = self.fuzz.generate(11)
+        self.assertEqual(json.loads(json.dumps(scenario)), scenario)
+        self.assertEqual(self.fuzz.run_scenario(scenario)[1], self.fuzz.run_scenario(scenario)[1])
+
+    def test_shrink_finds_a_minimal_scenario(self):
+        # Fails whenever a car is placed heading east with more than 30 steps to run.
+        fails = lambda s: s["steps"] > 30 and any(p[0] == "east" for p in s["placements"])
+        scenario = dict(self.fuzz.generate(0), steps=400, placements=[["north", None, 0, 0], ["east", "left", 0, 2], ["west", None, 0, 1]])
+        shrunk = self.fuzz.shrink(scenario, fails)
+        self.assertEqual(shrunk["placements"], [["east", "left", 0, 2]])
+        self.assertEqual(shrunk["steps"], 31)
+
+class TestMetrics(unittest.TestCase):
+    def run_with_metrics(self, metrics, seed=3):
+        random.seed(seed)
+        intersection = Intersection(10, 20, SimpleIntersection, is_test_mode=True, metrics=metrics)
+        for _ in intersection.run(snapshots=False): pass
+        return intersection
+
+    def test_metrics_do_not_change_the_run(self):
+        self.assertEqual(run_simulation(5, cars=12, metrics=True)["passed_cars"], run_simulation(5, cars=12)["passed_cars"])
+
+    def test_counters_match_the_run(self):
+        metrics = Metrics(timing_every=4)
+        intersection = self.run_with_metrics(metrics)
+        summary = metrics.summary()
+        self.assertEqual(summary["steps"], metrics.steps)
+        self.assertEqual(sum(metrics.phase_steps.values()), metrics.steps)
+        self.assertAlmostEqual(sum(summary["phase_occupancy"].values()), 1.0)
+        self.assertEqual(summary["wait"]["cars"], intersection.passed_cars)
+        self.assertEqual(metrics.wait[1], sum(stats[1] for stats in intersection.wait_stats.values()))
+        self.assertGreater(summary["travel"]["mean"], 0)
+        self.assertEqual(metrics.update_samples, (metrics.steps + 3) // 4)
+
+    def test_queue_counts_the_stopped_cars(self):
+        for engine in ('python', 'numpy') if importlib.util.find_spec("numpy") else ('python',):
+            intersection = Intersection(15, 60, SimpleIntersection, is_test_mode=True, seed=4, engine=engine, metrics=Metrics())
+            for _ in range(150):
+                intersection.pattern.step()
+                stopped = {d: sum(car.stopped and car.origin == d for car in intersection.cars) for d in intersection.queued}
+                self.assertEqual(intersection.metrics.queue, stopped, engine)
+
+    def test_sinks_and_prometheus(self):
+        jsonl, csv_stream = io.StringIO(), io.StringIO()
+        metrics = Metrics([JsonlSink(jsonl), CsvSink(csv_stream)])
+        intersection = self.run_with_metrics(metrics)
+        records = [json.loads(line) for line in jsonl.getvalue().splitlines()]
+        self.assertEqual(sum(r["type"] == "step" for r in records), metrics.steps)
+        self.assertEqual(sum(r["type"] == "car" for r in records), intersection.passed_cars)
+        self.assertEqual(len(csv_stream.getvalue().splitlines()), metrics.steps + 1)
+        text = metrics.prometheus(intersection)
+        self.assertIn(f"traffic_cars_passed_total {intersection.passed_cars}", text)
+        self.assertIn('traffic_queue_length{approach="north"}', text)
+        self.assertIn(f"traffic_car_travel_steps_count {intersection.passed_cars}", text)
+
+class TestTrace(unittest.TestCase):
+    def record(self, seed, path, capacity=15):
+        random.seed(seed)
+        intersection = Intersection(15, 30, ProtectedLeftTurn, is_test_mode=True, left_turn_percentage=0.3)
+        with open(path, 'wb') as f:
+            return list(TraceWriter(f, capacity)(intersection.run()))
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_replay_matches_recording(self):
+        path = os.path.join(self.tmp.name, "run.trace")
+        frames = self.record(4, path)
+        with TraceReader(path) as trace:
+            self.assertEqual(len(trace), len(frames))
+            self.assertEqual(list(trace), frames)
+            self.assertEqual(trace[-1], frames[-1])
+            i = trace.find_step(40)
+            self.assertEqual(trace[i].step, 40)
+            self.assertEqual(trace[i], frames[i])
+
+    def test_first_difference(self):
+        paths = [os.path.join(self.tmp.name, f"{n}.trace") for n in "abc"]
+        self.record(4, paths[0]); self.record(4, paths[1], capacity=20); self.record(5, paths[2])
+        with TraceReader(paths[0]) as a, TraceReader(paths[1]) as b, TraceReader(paths[2]) as c:
+            self.assertIsNone(first_difference(a, b))
+            self.assertIsNotNone(first_difference(a, c))
+
+    def test_large_capacity_and_unlimited_goal(self):
+        path = os.path.join(self.tmp.name, "long.trace")
+        intersection = Intersection(15, None, SimpleIntersection, is_test_mode=True, seed=2, max_steps=30)
+        with open(path, 'wb') as f:
+            frames = list(TraceWriter(f, 70000)(intersection.run()))
+        with TraceReader(path) as trace:
+            self.assertEqual((trace.capacity, trace.goal_cars), (70000, None))
+            self.assertEqual(list(trace), frames)
+
+    def test_capacity_is_enforced(self):
+        with self.assertRaises(ValueError):
+            self.record(4, os.path.join(self.tmp.name, "small.trace"), capacity=2)
+
+class TestPlanOptimizer(unittest.TestCase):
+    def test_search_improves_and_resumes_from_cache(self):
+        demand = {"pattern": "simple", "cars": 15, "turn_ratio": 0.2, "distribution": 0.5}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cache.jsonl")
+            cache = EvaluationCache(path)
+            optimizer = PlanOptimizer(SimpleIntersection.PLAN, range(4), demand, cache=cache, workers=1)
+            base_score = optimizer.score([SimpleIntersection.PLAN])[0]
+            plan, score = optimizer.run(max_rounds=4)
+            cache.close()
+            self.assertGreaterEqual(score, base_score)
+            self.assertEqual(len(plan.phases), len(SimpleIntersection.PLAN.phases))
+
+            resumed = PlanOptimizer(SimpleIntersection.PLAN, range(4), demand, cache=EvaluationCache(path), workers=1)
+            resumed_plan, resumed_score = resumed.run(max_rounds=4)
+            resumed.cache.close()
+            self.assertEqual((resumed_plan.phases, resumed_score), (plan.phases, score))
+            self.assertEqual(resumed.simulated, 0)
+
+    def test_wait_objective_charges_unfinished_cars(self):
+        wait = PlanOptimizer(SimpleIntersection.PLAN, range(1), {}, objective='wait').objective
+        everyone = {"steps": 100, "passed_cars": 20, "crashes": 0, "wait_cars": 20, "wait_total": 200, "unfinished": 0}
+        fewer = {"steps": 200, "passed_cars": 15, "crashes": 0, "wait_cars": 15, "wait_total": 60, "unfinished": 5}
+        self.assertGreater(wait([everyone]), wait([fewer]))
+
+    def test_clearance_phases_keep_their_floor(self):
+        optimizer = PlanOptimizer(SimpleIntersection.PLAN, range(1), {}, min_duration=1, min_clearance=2)
+        neighbours = list(optimizer.neighbours((10, 3, 2, 10, 3, 2), 1))
+        for durations in neighbours:
+            self.assertTrue(all(durations[i] >= 2 for i in (1, 2, 4, 5)), durations)
+        self.assertIn((9, 3, 2, 10, 3, 2), neighbours)
+        self.assertIn((10, 2, 2, 10, 3, 2), neighbours)
+        geometry = Geometry(lanes=2)
+        plan = SimpleIntersection.PLAN.with_clearance(geometry.clearance)
+        optimizer = PlanOptimizer(plan, range(1), {"geometry": geometry}, min_duration=1, min_clearance=2)
+        for durations in optimizer.neighbours(tuple(d for _, d in plan.phases), 1):
+            self.assertGreaterEqual(plan.with_durations(durations).clearance(), geometry.clearance)
+
+@unittest.skipIf(importlib.util.find_spec("numpy") is None, "numpy is not installed")
+class TestNumpyEngine(unittest.TestCase):
+    def trajectory(self, engine, pattern_class, seed):
+        random.seed(seed)
+        intersection = Intersection(15, 60, pattern_class, is_test_mode=True, left_turn_percentage=0.4,
+                                    distribution_factor=0.5, ignore_crashes=True, engine=engine)
+        steps = []
+        while not intersection.is_finished():
+            intersection.pattern.cycle()
+            steps.append([(car.id, car.x, car.y, car.direction, car.turn, car.stopped) for car in intersection.cars])
+        return steps, intersection.passed_cars, intersection.crashes
+
+    def test_trajectories_match_reference(self):
+        for pattern_class in (SimpleIntersection, ProtectedLeftTurn):
+            for seed in range(5):
+                self.assertEqual(self.trajectory('numpy', pattern_class, seed),
+                                 self.trajectory('python', pattern_class, seed))
+
+    def test_crash_matches_reference(self):
+        for engine in ('python', 'numpy'):
+            intersection = Intersection(10, 20, SimpleIntersection, is_test_mode=True, engine=engine)
+            car1 = Car(1, "north"); car1.y = LANE_E_Y + 1
+            car2 = Car(2, "east"); car2.x, car2.y = LANE_N_X - 1, LANE_E_Y
+            intersection.cars = [car1, car2]
+            intersection.pattern.lights.update({'north': Light.GREEN, 'east': Light.GREEN})
+            intersection.update_cars()
+            self.assertEqual(intersection.crashes, 1)
+            self.assertEqual([(c.x, c.y, c.stopped) for c in intersection.cars],
+                             [(LANE_N_X, LANE_E_Y, False), (LANE_N_X - 1, LANE_E_Y, True)])
+
+class TestTerminalRenderer(unittest.TestCase):
+    def apply(self, screen, output):
+        # A minimal terminal: cursor moves, clear-to-end-of-line, colors ignored.
+        row = col = 0
+        for token in re.findall(r"\x1b\[[0-9;?]*[A-Za-z]|\x1b\(B|[^\x1b]", output):
+            move = re.fullmatch(r"\x1b\[(\d+);(\d+)H", token)
+            if move:
+                row, col = int(move.group(1)) - 1, int(move.group(2)) - 1
+            elif token == "\x1b[K":
+                screen[row] = screen[row][:col]
+            elif not token.startswith("\x1b"):
+                line = screen.setdefault(row, "").ljust(col)
+                screen[row] = line[:col] + token + line[col + 1:]
+                col += 1
+        return screen
+
+    def test_frames_match_grid_and_only_redraw_changes(self):
+        strip = lambda text: re.sub(r"\x1b\[[0-9;]*m|\x1b\(B", "", text)
+        intersection = Intersection(15, 100, ProtectedLeftTurn, is_test_mode=True, left_turn_percentage=0.5)
+        stream = io.StringIO()
+        renderer = TerminalRenderer(stream)
+        screen = {}
+        for step in range(40):
+            if step % 7 == 0:
+                intersection.pattern.lights['north'] = [Light.GREEN, Light.GREEN_ARROW, Light.RED][step % 3]
+                intersection.pattern.lights['east'] = Light.GREEN
+            intersection.steps += 1
+            intersection.update_cars()
+            stream.seek(0); stream.truncate()
+            renderer.render(intersection.step_snapshot())
+            self.apply(screen, stream.getvalue())
+            intersection.update_grid()
+            for y, row in enumerate(intersection.grid):
+                self.assertEqual(screen[y + 1], strip("".join(row)).rstrip().ljust(len(screen[y + 1])))
+        self.assertIn("Step: 40", screen[len(intersection.grid) + 2])
+        self.assertNotIn("\x1b[2J", stream.getvalue())
+        self.assertLess(stream.getvalue().count("H"), 60)
+
+    def test_viewport_of_a_large_layout(self):
+        strip = lambda text: re.sub(r"\x1b\[[0-9;]*m|\x1b\(B", "", text)
+        geometry = Geometry(approach_length=2000, lanes=2)
+        intersection = Intersection(40, 1000, SimpleIntersection, is_test_mode=True, seed=1, arrival_rate=1.0, geometry=geometry)
+        for _ in range(30): intersection.pattern.step()
+        stream = io.StringIO()
+        renderer = TerminalRenderer(stream, viewport=(geometry.center - 10, geometry.center - 10, 21, 21))
+        renderer.render(intersection.step_snapshot())
+        screen = self.apply({}, stream.getvalue())
+        self.assertEqual(max(len(strip(screen[row])) for row in range(1, 22)), 21)
+        self.assertIn("Step: 30", screen[23])
+        self.assertLess(len(stream.getvalue()), 5000)
+
+        # Scrolling to the start of the west approach shows the cars that just entered.
+        stream.seek(0); stream.truncate()
+        renderer.scroll(-(geometry.center - 10), 0)
+        intersection.pattern.step()
+        renderer.render(intersection.step_snapshot())
+        screen = self.apply({}, stream.getvalue())
+        east_lanes = [y - renderer.viewport[1] + 1 for _, y in geometry.entry_cells["east"]]
+        self.assertTrue(any("■" in strip(screen[row]) for row in east_lanes))
+
+class TestColors(unittest.TestCase):
+    def tearDown(self):
+        set_color_mode(None)
+
+    def test_import_spawns_no_processes(self):
+        code = ("import sys; spawned = []\n"
+                "sys.addaudithook(lambda event, args: spawned.append(event) if event in "
+                "('subprocess.Popen', 'os.system', 'os.posix_spawn', 'os.exec', 'os.fork') else None)\n"
+                "import traffic; print(len(spawned))")
+        root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+        result = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), "0")
+
+    def test_color_modes(self):
+        set_color_mode(False)
+        self.assertEqual(Color.GREEN, "")
+        self.assertEqual(LIGHT_SYMBOL[Light.RED], "●")
+        set_color_mode(True)
+        self.assertTrue(Color.GREEN.startswith("\x1b"))
+        self.assertTrue(LIGHT_SYMBOL[Light.RED].startswith("\x1b"))
+
+class TestStateSnapshots(unittest.TestCase):
+    def make(self, seed=11, warmup=60, **kw):
+        intersection = Intersection(15, 200, ProtectedLeftTurn, is_test_mode=True, left_turn_percentage=0.3, seed=seed, **kw)
+        for _ in range(warmup): intersection.pattern.step()
+        return intersection
+
+    def trajectory(self, intersection, steps=60):
+        states = []
+        for _ in range(steps):
+            intersection.pattern.step()
+            states.append((intersection.steps, intersection.passed_cars,
+                           [(car.id, car.x, car.y, car.direction, car.turn, car.stopped) for car in intersection.cars]))
+        return states
+
+    def test_seeded_runs_ignore_global_random(self):
+        random.seed(1); first = self.trajectory(self.make())
+        random.seed(2); second = self.trajectory(self.make())
+        self.assertEqual(first, second)
+
+    def test_restore_replays_the_same_future(self):
+        intersection = self.make()
+        state = intersection.snapshot()
+        first = self.trajectory(intersection)
+        intersection.restore(state)
+        self.assertEqual(self.trajectory(intersection), first)
+
+    def test_fork_is_independent(self):
+        intersection = self.make(warmup=20, arrival_rate=0.5)
+        fork = intersection.fork()
+        reseeded = [intersection.fork(seed=99), intersection.fork(seed=100)]
+        expected = self.trajectory(intersection)
+        self.assertEqual(self.trajectory(fork), expected)
+        self.assertNotEqual(self.trajectory(reseeded[0]), self.trajectory(reseeded[1]))
+
+class TestRoadNetwork(unittest.TestCase):
+    def test_cars_cross_between_intersections(self):
+        for workers in (1, 2):
+            with RoadNetwork(2, 2, workers=workers, seed=3, cars=12, ignore_crashes=True) as network:
+                stats = network.run(300)
+            self.assertGreater(stats["handovers"], 0)
+            self.assertGreater(stats["exited"], 0)
+            self.assertEqual(stats["created"], stats["exited"] + stats["on_network"])
+
+    def test_results_do_not_depend_on_workers(self):
+        results = []
+        for workers in (1, 2):
+            with RoadNetwork(3, 2, workers=workers, seed=5, cars=10, ignore_crashes=True) as network:
+                results.append(network.run(150))
+        self.assertEqual(results[0], results[1])
+
+    def test_networks_drain_without_stalling(self):
+        for pattern in ('simple', 'actuated', 'protected-left'):
+            with RoadNetwork(3, 3, pattern=pattern, cars=15) as network:
+                stats = network.run(1500)
+            self.assertEqual(stats["stalled"], [], pattern)
+            self.assertEqual(stats["crashes"], 0, pattern)
+            self.assertEqual(stats["on_network"], 0, pattern)
+            self.assertEqual(stats["exited"], stats["created"], pattern)
+
+    def test_the_original_look_ahead_rule_is_honoured(self):
+        with RoadNetwork(3, 3, geometry=Geometry(heading_look_ahead=False)) as network:
+            stats = network.run(2000)
+        self.assertTrue(stats["stalled"]) # the sideways rule locks up under sustained demand
+        self.assertLess(stats["ticks"], 2000)
+
+    def test_stalled_intersections_end_the_run(self):
+        network = RoadNetwork(2, 2, cars=5, stall_ticks=20)
+        node = network.regions[0].nodes[(1, 1)]
+        def all_red(): # this intersection's lights never change
+            node.steps += 1
+            node.update_cars()
+        node.pattern.lights = dict.fromkeys(node.pattern.lights, Light.RED)
+        node.pattern.step = all_red
+        stats = network.run(1000)
+        self.assertLess(stats["ticks"], 1000)
+        self.assertEqual([s[:2] for s in stats["stalled"]], [(1, 1)])
+        self.assertGreater(stats["stalled"][0][2], 0)
+
+    def test_only_boundary_approaches_spawn(self):
+        network = RoadNetwork(3, 3, cars=5)
+        nodes = network.regions[0].nodes
+        self.assertEqual(nodes[(1, 1)].approaches, [])
+        self.assertEqual(nodes[(0, 1)].approaches, ["south"])
+        self.assertEqual(sorted(nodes[(2, 2)].approaches), ["north", "west"])
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
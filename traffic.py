@@ -15,23 +15,76 @@
 
 import time
 import os
+import sys
 import random
+import functools
+import collections
+import copy
+import itertools
+import math
+import bisect
+import struct
 from enum import Enum
 import argparse
 
+np = None # numpy is only needed by NumpyEngine, which imports it on first use
+
 VERSION = "1.0"
 MAX_STEPS = 200
+CLEANUP_STEPS = 50
+DIRECTIONS = ["north", "south", "east", "west"]
+
+# ANSI escape codes for colors. Nothing is looked up at import time: each color is
+# resolved from terminfo (in-process, via curses) the first time it is used, with a
+# built-in ANSI table as fallback, and cached from then on.
+COLOR_CODES = {"GREEN": 2, "RED": 1, "YELLOW": 3, "GREY": 240}
+BUILTIN_COLORS = {"GREEN": "\x1b[32m", "RED": "\x1b[31m", "YELLOW": "\x1b[33m", "GREY": "\x1b[38;5;240m", "RESET": "\x1b[0m"}
+_color_mode = None # None: auto-detect, True/False: forced on/off
+
+def set_color_mode(enabled):
+    # False gives a headless/no-color mode (every color is ""); None restores auto-detection.
+    global _color_mode
+    _color_mode = enabled
+    for name in BUILTIN_COLORS:
+        if name in Color.__dict__: delattr(Color, name)
+    _terminfo.cache_clear()
+    LIGHT_SYMBOL.clear()
+    _light_parts.cache_clear()
+
+def colors_enabled():
+    if _color_mode is not None: return _color_mode
+    if os.environ.get("NO_COLOR"): return False
+    return sys.stdout.isatty() and os.environ.get("TERM", "dumb") != "dumb"
+
+@functools.lru_cache(maxsize=None)
+def _terminfo(capability, *params):
+    try:
+        import curses
+        try:
+            value = curses.tigetstr(capability)
+        except curses.error: # terminal not set up yet
+            curses.setupterm(fd=sys.stdout.fileno())
+            value = curses.tigetstr(capability)
+        if value and params: value = curses.tparm(value, *params)
+        return value.decode() if value else None
+    except Exception:
+        return None
 
-# ANSI escape codes for colors
 def get_color(color_code):
-    return os.popen(f'tput setaf {color_code}').read()
+    if not colors_enabled(): return ""
+    return _terminfo("setaf", color_code) or f"\x1b[38;5;{color_code}m"
 
-class Color:
-    GREEN = get_color(2)
-    RED = get_color(1)
-    YELLOW = get_color(3)
-    GREY = get_color(240)
-    RESET = os.popen('tput sgr0').read()
+class _LazyColor(type):
+    def __getattr__(cls, name):
+        if name not in BUILTIN_COLORS: raise AttributeError(name)
+        if not colors_enabled(): value = ""
+        elif name == "RESET": value = _terminfo("sgr0") or BUILTIN_COLORS[name]
+        else: value = _terminfo("setaf", COLOR_CODES[name]) or BUILTIN_COLORS[name]
+        setattr(cls, name, value) # later lookups are plain attribute reads
+        return value
+
+class Color(metaclass=_LazyColor):
+    pass
 
 class Light(Enum):
     GREEN = "GREEN"
@@ -40,17 +93,26 @@ class Light(Enum):
     RED = "RED"
 
 UNLIT_BULB = "⚪"
-LIGHT_SYMBOL = {
-    Light.RED: f"{Color.RED}●{Color.RESET}",
-    Light.YELLOW: f"{Color.YELLOW}●{Color.RESET}",
-    Light.GREEN: f"{Color.GREEN}●{Color.RESET}",
-    Light.GREEN_ARROW: f"{Color.GREEN}◄{Color.RESET}",
-    "RED_UNLIT": f"{Color.GREY}●{Color.RESET}",
-    "YELLOW_UNLIT": f"{Color.GREY}●{Color.RESET}",
-    "GREEN_UNLIT": f"{Color.GREY}●{Color.RESET}",
-    "GREEN_ARROW_UNLIT": f"{Color.GREY}◄{Color.RESET}",
+LIGHT_GLYPHS = {
+    Light.RED: ("RED", "●"),
+    Light.YELLOW: ("YELLOW", "●"),
+    Light.GREEN: ("GREEN", "●"),
+    Light.GREEN_ARROW: ("GREEN", "◄"),
+    "RED_UNLIT": ("GREY", "●"),
+    "YELLOW_UNLIT": ("GREY", "●"),
+    "GREEN_UNLIT": ("GREY", "●"),
+    "GREEN_ARROW_UNLIT": ("GREY", "◄"),
 }
 
+class _LightSymbols(dict):
+    # Symbols are colored on first use, so building the table costs nothing at import.
+    def __missing__(self, key):
+        color, glyph = LIGHT_GLYPHS[key]
+        symbol = self[key] = f"{getattr(Color, color)}{glyph}{Color.RESET}"
+        return symbol
+
+LIGHT_SYMBOL = _LightSymbols()
+
 # Grid dimensions
 GRID_WIDTH = 21
 GRID_HEIGHT = 21
@@ -65,130 +127,505 @@ INTERSECTION_START_X = (GRID_WIDTH // 2) - INTERSECTION_SIZE
 INTERSECTION_END_X = (GRID_WIDTH // 2) + INTERSECTION_SIZE
 INTERSECTION_START_Y = (GRID_HEIGHT // 2) - INTERSECTION_SIZE
 INTERSECTION_END_Y = (GRID_HEIGHT // 2) + INTERSECTION_SIZE
+ENTRY_CELLS = {"north": (LANE_N_X, GRID_HEIGHT - 1), "south": (LANE_S_X, 0), "east": (0, LANE_W_Y), "west": (GRID_WIDTH - 1, LANE_E_Y)}
+LEFT_OF = {"north": "west", "south": "east", "east": "north", "west": "south"}
+MOVES = {"north": (0, -1), "south": (0, 1), "east": (1, 0), "west": (-1, 0)}
+LOOK_AHEAD = {d: (2 * dx, 2 * dy) for d, (dx, dy) in MOVES.items()} # two cells on, whatever the heading
+SIDEWAYS_LOOK_AHEAD = {"north": (0, -2), "south": (0, 2), "east": (0, 2), "west": (0, -2)} # the original rule: eastbound looks at y + 2
+# The lights a car waiting at the stop line halts for, by its turn.
+HALTS = {None: frozenset((Light.YELLOW, Light.RED)), "left": frozenset((Light.GREEN, Light.YELLOW, Light.RED))}
+
+class Geometry:
+    # The layout of one intersection: `approach_length` cells of road before the junction
+    # on each side and `lanes` lanes in each direction, numbered from the centre line out.
+    # Only coordinates and per-lane cell maps are stored, so memory follows the number
+    # of lanes and the approach length, never the area of the grid. The default is the
+    # 21x21 single-lane layout the module constants describe.
+    #
+    # Before moving, a car checks one look-ahead cell, two cells along its heading. With
+    # heading_look_ahead=False cars use the original rule instead, where eastbound and
+    # westbound cars look two cells sideways, into a crossing lane: under sustained demand
+    # a car in the junction then waits on the cross street's queue while that queue waits
+    # on it, and traffic locks up. It is kept to reproduce runs made with it.
+    def __init__(self, approach_length=INTERSECTION_START_X, lanes=1, heading_look_ahead=True):
+        if approach_length < 5 or lanes < 1:
+            raise ValueError("Approaches must be at least 5 cells long, with at least one lane.")
+        self.approach_length, self.lanes = approach_length, lanes
+        self.heading_look_ahead = heading_look_ahead
+        self.look_ahead = LOOK_AHEAD if heading_look_ahead else SIDEWAYS_LOOK_AHEAD
+        # Yellow plus all-red steps a plan needs before a crossing approach goes green: a
+        # car entering on the last green step takes 2 * lanes + 1 steps to cross the
+        # junction, plus the two steps of margin the built-in plans give one lane.
+        self.clearance = 2 * lanes + 3
+        # What a plan given explicitly must leave. One-lane plans are taken as written,
+        # as they always have been; wider junctions need the scaled clearance.
+        self.required_clearance = self.clearance if lanes > 1 else None
+        c = self.center = approach_length + lanes
+        self.width = self.height = 2 * c + 1
+        self.start_x = self.start_y = c - lanes
+        self.end_x = self.end_y = c + lanes
+        lane_x = {"north": [c + 1 + k for k in range(lanes)], "south": [c - 1 - k for k in range(lanes)]}
+        lane_y = {"east": [c + 1 + k for k in range(lanes)], "west": [c - 1 - k for k in range(lanes)]}
+        self._columns = frozenset(lane_x["north"] + lane_x["south"])
+        self._rows = frozenset(lane_y["east"] + lane_y["west"])
+        last = self.width - 1
+        # Per direction, one cell per lane: where cars enter, and where they wait for the light.
+        self.entry_cells = {"north": tuple((x, last) for x in lane_x["north"]), "south": tuple((x, 0) for x in lane_x["south"]),
+                            "east": tuple((0, y) for y in lane_y["east"]), "west": tuple((last, y) for y in lane_y["west"])}
+        self.stop_line_cells = {"north": tuple((x, self.end_y + 1) for x in lane_x["north"]),
+                                "south": tuple((x, self.start_y - 1) for x in lane_x["south"]),
+                                "east": tuple((self.start_x - 1, y) for y in lane_y["east"]),
+                                "west": tuple((self.end_x + 1, y) for y in lane_y["west"])}
+        # Every approach lane cell from the entry up to the stop line: cell -> approach.
+        self.approach_cells = {}
+        for x in lane_x["north"]: self.approach_cells.update({(x, y): "north" for y in range(self.end_y + 1, self.height)})
+        for x in lane_x["south"]: self.approach_cells.update({(x, y): "south" for y in range(0, self.start_y)})
+        for y in lane_y["east"]: self.approach_cells.update({(x, y): "east" for x in range(0, self.start_x)})
+        for y in lane_y["west"]: self.approach_cells.update({(x, y): "west" for x in range(self.end_x + 1, self.width)})
+        # A left turn from lane k goes into lane k of the crossing road, which puts the
+        # turning cell of northbound and southbound cars at y == 2c - x, and of eastbound
+        # and westbound cars at x == y.
+        self.mirror = 2 * c
+        self._rows_cache = None
+        self.routes = [] # every Route built for this layout, indexed by route id
+        self._route_index = {} # (heading, turn, cell) -> (route, index)
+        self._route_cells = 0
+        # Conflict matrix over the one-cell moves of every route: (from, to) -> the moves
+        # out of `to` it conflicts with, those that do not carry straight on from `from`
+        # (a swap when they go back to `from`, a crossing otherwise). Two moves into the
+        # same cell always conflict and need no entry.
+        self.conflicts = {}
+        self._moves_from, self._moves_into = {}, {}
+
+    def __eq__(self, other):
+        return isinstance(other, Geometry) and self.__getstate__() == other.__getstate__()
+
+    def __hash__(self):
+        return hash(self.__getstate__())
+
+    def __repr__(self):
+        look_ahead = "" if self.heading_look_ahead else ", heading_look_ahead=False"
+        return f"Geometry(approach_length={self.approach_length}, lanes={self.lanes}{look_ahead})"
+
+    def __getstate__(self):
+        return self.approach_length, self.lanes, self.heading_look_ahead
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def turns_left_at(self, direction, x, y):
+        if direction == "north" or direction == "south": return y == self.mirror - x
+        return x == y
+
+    def at_stop_line(self, direction, x, y):
+        if direction == "north": return y == self.end_y + 1
+        if direction == "south": return y == self.start_y - 1
+        if direction == "east": return x == self.start_x - 1
+        return x == self.end_x + 1
+
+    def in_junction(self, x, y):
+        return self.start_x <= x <= self.end_x and self.start_y <= y <= self.end_y
+
+    def contains(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def route(self, direction, turn, x, y):
+        # The route a car at (x, y) heading `direction` follows, and its index on it.
+        # Every movement from every entry cell is built on first use; a car anywhere
+        # else gets a route traced from where it stands.
+        self._build_routes()
+        found = self._route_index.get((direction, turn, (x, y)))
+        if found is None: found = self._add_route(Route(self, direction, turn, x, y)), 0
+        return found
+
+    def _build_routes(self):
+        if self.routes: return
+        for turn in HALTS:
+            for d in DIRECTIONS:
+                for cell in self.entry_cells[d]: self._add_route(Route(self, d, turn, *cell))
+
+    def _add_route(self, route):
+        route.id, route.base = len(self.routes), self._route_cells
+        self.routes.append(route)
+        self._route_cells += len(route.cells)
+        for i, key in enumerate(zip(route.headings, route.turns, route.cells)):
+            self._route_index.setdefault(key, (route, i))
+        for a, b in zip(route.cells, route.cells[1:]):
+            if b in self._moves_from.get(a, ()): continue
+            for c in self._moves_from.get(b, ()):
+                if c != (2 * b[0] - a[0], 2 * b[1] - a[1]): self._conflict((a, b), (b, c))
+            for p in self._moves_into.get(a, ()):
+                if b != (2 * a[0] - p[0], 2 * a[1] - p[1]): self._conflict((p, a), (a, b))
+            self._moves_from.setdefault(a, set()).add(b)
+            self._moves_into.setdefault(b, set()).add(a)
+        return route
+
+    def _conflict(self, entering, leaving):
+        self.conflicts.setdefault(entering, set()).add(leaving)
+        self.conflicts.setdefault(leaving, set()).add(entering)
+
+    def _on_route(self, car):
+        route, pos = car.route, car.pos
+        return route.id < len(self.routes) and self.routes[route.id] is route and route.cells[pos] == (car.x, car.y) \
+            and route.headings[pos] == car.direction and route.turns[pos] == car.turn
+
+    def anchor(self, car):
+        # Puts a car back on a route of this layout if it is no longer where its own
+        # route says (moved by hand, or built for another layout).
+        if not self._on_route(car): car.route, car.pos = self.route(car.direction, car.turn, car.x, car.y)
+
+    def has_route(self, car):
+        # Whether anchor(car) can do without tracing a route this layout has not built.
+        if self._on_route(car): return True
+        self._build_routes()
+        return (car.direction, car.turn, (car.x, car.y)) in self._route_index
+
+    def copy(self):
+        # The same layout with none of this one's routes, for routes one user must not
+        # add to a layout others share.
+        return Geometry(*self.__getstate__())
+
+    def road_glyph(self, x, y):
+        # The static road drawing at a cell, computed rather than stored.
+        column, row = x in self._columns, y in self._rows
+        if column and row: return "╬"
+        if column: return "║"
+        if row: return "═"
+        return " "
+
+    def road_rows(self):
+        # The whole road layer as rows of glyphs, built on first use for callers that
+        # want a dense grid (update_grid); the renderer never needs it.
+        if self._rows_cache is None:
+            self._rows_cache = tuple(tuple(self.road_glyph(x, y) for x in range(self.width)) for y in range(self.height))
+        return self._rows_cache
+
+    def light_cells(self, lights, is_protected):
+        # Where each approach's signal is drawn: (x, y) -> glyph.
+        cells = {}
+        for i, p in enumerate(_light_parts(lights['south'], is_protected)): cells[(self.start_x - 2, self.start_y - 1 - i)] = p
+        for i, p in enumerate(_light_parts(lights['north'], is_protected)): cells[(self.end_x + 2, self.end_y + 1 + i)] = p
+        parts = _light_parts(lights['east'], is_protected)
+        for i, p in enumerate(parts): cells[(self.start_x - 1 - len(parts) + i, self.end_y + 2)] = p
+        for i, p in enumerate(_light_parts(lights['west'], is_protected)): cells[(self.end_x + 2 + i, self.start_y - 2)] = p
+        return cells
 
+class Route:
+    # One movement through an intersection, precomputed so that moving a car is an index
+    # increment and a table read: the cells a car visits from where it starts to the
+    # first cell off the grid, with its heading, turn and look-ahead cell at each, the
+    # index of its stop line (-1 if it has none) and the indices inside the junction.
+    # Adding a movement (a right turn, a U-turn) means tracing a new route, not new code.
+    def __init__(self, geometry, direction, turn, x, y):
+        self.cells, self.headings, self.turns, self.buffers = [], [], [], []
+        self.stop, self.approach, self.halts = -1, direction, frozenset()
+        zone = []
+        while True:
+            self.cells.append((x, y)); self.headings.append(direction); self.turns.append(turn)
+            dx, dy = geometry.look_ahead[direction]
+            self.buffers.append((x + dx, y + dy))
+            if not geometry.contains(x, y) and len(self.cells) > 1: break
+            if self.stop < 0 and geometry.at_stop_line(direction, x, y):
+                self.stop, self.approach, self.halts = len(self.cells) - 1, direction, HALTS.get(turn, frozenset())
+            if geometry.in_junction(x, y): zone.append(len(self.cells) - 1)
+            dx, dy = MOVES[direction]
+            x += dx; y += dy
+            if turn == "left" and geometry.turns_left_at(direction, x, y): direction, turn = LEFT_OF[direction], None
+        self.zone = range(zone[0], zone[-1] + 1) if zone else range(0)
+        self.id = self.base = -1 # set when added to a Geometry
+
+    def __repr__(self):
+        return f"Route({self.id}: {self.cells[0]} -> {self.cells[-1]})"
+
+DEFAULT_GEOMETRY = Geometry()
 
 class Car:
-    def __init__(self, car_id, direction, turn=None):
+    def __init__(self, car_id, direction, turn=None, lane=0, geometry=None):
         self.id = car_id
         self.direction = direction
         self.turn = turn
         self.color = Color.GREEN
         self.stopped = False
-        
-        if direction == "north":
-            self.x, self.y = LANE_N_X, GRID_HEIGHT - 1
-        elif direction == "south":
-            self.x, self.y = LANE_S_X, 0
-        elif direction == "east":
-            self.x, self.y = 0, LANE_W_Y
-        elif direction == "west":
-            self.x, self.y = GRID_WIDTH - 1, LANE_E_Y
+        self.origin = direction
+        self.wait = 0
+        self.entered = 0 # step the car entered the grid
+        geometry = geometry or DEFAULT_GEOMETRY
+        self.x, self.y = geometry.entry_cells[direction][lane]
+        self.route, self.pos = geometry.route(direction, turn, self.x, self.y)
 
     def __repr__(self):
         return f"{self.color}■{Color.RESET}"
 
     def move(self):
-        # Handle turns inside the intersection
-        if self.turn == "left":
-            turned = False
-            # Northbound turning West
-            if self.direction == "north" and self.y == LANE_E_Y:
-                self.direction = "west"
-                turned = True
-            # Southbound turning East
-            elif self.direction == "south" and self.y == LANE_W_Y:
-                self.direction = "east"
-                turned = True
-            # Eastbound turning North
-            elif self.direction == "east" and self.x == LANE_N_X:
-                self.direction = "north"
-                turned = True
-            # Westbound turning South
-            elif self.direction == "west" and self.x == LANE_S_X:
-                self.direction = "south"
-                turned = True
-            
-            if turned:
-                self.turn = None
-
-        if self.direction == "north":
-            self.y -= 1
-        elif self.direction == "south":
-            self.y += 1
-        elif self.direction == "east":
-            self.x += 1
-        elif self.direction == "west":
-            self.x -= 1
+        # One cell along the car's route; turns are part of the route.
+        route = self.route
+        self.pos = pos = self.pos + 1
+        self.x, self.y = route.cells[pos]
+        self.direction = route.headings[pos]; self.turn = route.turns[pos]
+
+class ArrivalProcess:
+    # Streams the approaches that new cars arrive on, in O(1) time and memory per car.
+    # A distribution_factor share of demand is spread evenly over the approaches and the
+    # rest goes to one approach picked at random, matching --distribution. Without a rate,
+    # next() draws one arrival on demand; with a rate (cars per step over all approaches),
+    # step() draws each approach's arrivals for one step from a Poisson distribution.
+    # `total` caps the number of arrivals; None streams forever. Draws come from `rng`
+    # (the owning Intersection's generator), or the global random module if not given.
+    def __init__(self, approaches, distribution_factor=1.0, rate=None, total=None, rng=None):
+        self.rng = rng or random
+        self.approaches = list(approaches)
+        self.rate = rate
+        self.remaining = total
+        self.shares = []
+        if self.approaches:
+            heavy = self.rng.choice(self.approaches) if distribution_factor < 1.0 else None
+            even = distribution_factor / len(self.approaches)
+            self.shares = [even + (1.0 - distribution_factor if a == heavy else 0.0) for a in self.approaches]
+        self._cumulative = list(itertools.accumulate(self.shares))
+        self._limits = [math.exp(-rate * share) for share in self.shares] if rate else []
+
+    def next(self):
+        if self.remaining == 0 or not self.approaches: return None
+        if self.remaining is not None: self.remaining -= 1
+        return self.rng.choices(self.approaches, cum_weights=self._cumulative)[0]
+
+    def step(self):
+        arrivals = []
+        rand = self.rng.random
+        for approach, limit in zip(self.approaches, self._limits):
+            # Knuth's method; the per-approach mean is small, so this takes a few draws.
+            product = rand()
+            while product > limit:
+                if self.remaining == 0: return arrivals
+                if self.remaining is not None: self.remaining -= 1
+                arrivals.append(approach)
+                product *= rand()
+        return arrivals
+
+class TimingPlan:
+    # A signal timing plan declared as data: a sequence of phases, each setting the light
+    # for every approach for a number of steps, plus an offset into the cycle (to stagger
+    # neighbouring intersections). The plan is compiled into a step -> lights table, so
+    # the lights for any step are a single lookup.
+    def __init__(self, phases, offset=0, name=None):
+        self.phases = tuple((dict(lights), duration) for lights, duration in phases)
+        self.offset = offset
+        self.name = name
+        if not self.phases:
+            raise ValueError("A timing plan needs at least one phase.")
+        for lights, duration in self.phases:
+            if set(lights) != set(DIRECTIONS) or not all(isinstance(light, Light) for light in lights.values()):
+                raise ValueError(f"Each phase must set a Light for {', '.join(DIRECTIONS)}; got {lights}.")
+            if not isinstance(duration, int) or duration < 1:
+                raise ValueError(f"Phase durations must be positive integers; got {duration!r}.")
+        self.cycle_length = sum(duration for _, duration in self.phases)
+        self._table = tuple(i for i, (_, duration) in enumerate(self.phases) for _ in range(duration))
+
+    def position(self, step):
+        return (step + self.offset) % self.cycle_length
+
+    def phase_at(self, step):
+        return self._table[(step + self.offset) % self.cycle_length]
+
+    def lights_at(self, step):
+        # The lights in force during the given step. Callers must not modify the result.
+        return self.phases[self._table[(step + self.offset) % self.cycle_length]][0]
+
+    def clearances(self):
+        # For each phase that gives a green (or green arrow) to an approach that did not
+        # have one: (phase index, steps since an approach it holds at red last had a
+        # green), i.e. the yellow and all-red time before it.
+        going = [frozenset(d for d, light in lights.items() if light in (Light.GREEN, Light.GREEN_ARROW)) for lights, _ in self.phases]
+        result = []
+        for j in range(len(self.phases)):
+            if not going[j] - going[j - 1]: continue
+            steps, i = 0, j - 1
+            while going[i % len(self.phases)] <= going[j] and i > j - len(self.phases):
+                steps += self.phases[i % len(self.phases)][1]; i -= 1
+            if i > j - len(self.phases): result.append((j, steps))
+        return result
+
+    def clearance(self):
+        # The shortest clearance interval in the cycle (None if nothing ever crosses).
+        return min((steps for _, steps in self.clearances()), default=None)
+
+    def with_clearance(self, steps):
+        # This plan with every clearance interval shorter than `steps` made up to it by
+        # lengthening the phase just before the green (the all-red in built-in plans).
+        durations = [duration for _, duration in self.phases]
+        for j, clearance in self.clearances():
+            if clearance >= steps: continue
+            if clearance == 0:
+                raise ValueError(f"Phase {j} of {self.name or 'the plan'} starts a crossing green with no clearance phase before it.")
+            durations[j - 1] += steps - clearance
+        return self if durations == [duration for _, duration in self.phases] else self.with_durations(durations)
+
+    def with_durations(self, durations, offset=None):
+        return TimingPlan([(lights, duration) for (lights, _), duration in zip(self.phases, durations)],
+                          self.offset if offset is None else offset, self.name)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "offset": self.offset,
+            "phases": [{"lights": {d: light.value for d, light in lights.items()}, "duration": duration}
+                       for lights, duration in self.phases],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        try:
+            phases = [({d: Light[light] for d, light in phase["lights"].items()}, phase["duration"]) for phase in data["phases"]]
+        except KeyError as e:
+            raise ValueError(f"Invalid timing plan: unknown or missing {e}.") from None
+        return cls(phases, data.get("offset", 0), data.get("name"))
+
+    def __repr__(self):
+        durations = "/".join(str(duration) for _, duration in self.phases)
+        return f"TimingPlan({self.name!r}, durations={durations}, offset={self.offset})"
+
+def load_plans(path):
+    # A JSON file holding one plan object or a list of them.
+    import json
+    with open(path) as f:
+        data = json.load(f)
+    return [TimingPlan.from_dict(plan) for plan in (data if isinstance(data, list) else [data])]
 
 class TrafficPattern:
-    def __init__(self, intersection):
+    PLAN = None
+
+    def __init__(self, intersection, plan=None):
         self.intersection = intersection
+        # Built-in plans stretch their clearance to the layout's junction; a plan given
+        # explicitly must already leave what the layout requires.
+        geometry = intersection.geometry
+        required = geometry.required_clearance
+        if plan is None:
+            plan = self.PLAN and self.PLAN.with_clearance(geometry.clearance)
+        elif required is not None and plan.clearance() is not None and plan.clearance() < required:
+            raise ValueError(f"{plan!r} leaves {plan.clearance()} steps of yellow and all-red before a crossing green; "
+                             f"this layout needs at least {required}.")
+        self.plan = plan
         self.lights = {}
 
     def _run_phase(self, duration):
         for _ in range(duration):
             if self.intersection.is_finished() or (self.intersection.crash_detected and not self.intersection.ignore_crashes):
                 return True # Indicate simulation should stop
+            self.lights.update(self.plan.lights_at(self.intersection.steps))
             self.intersection.steps += 1
             self.intersection.update_cars()
-            if not self.intersection.is_test_mode:
-                self.intersection.print_state()
-                time.sleep(0.25)
         return False # Indicate phase complete, continue simulation
 
     def cycle(self):
-        raise NotImplementedError
+        # Runs to the end of the current cycle. A cycle cut short by a stop resumes from
+        # the step it stopped at, since the lights are looked up from the step count.
+        if self.plan is None: raise NotImplementedError
+        self._run_phase(self.plan.cycle_length - self.plan.position(self.intersection.steps))
+
+    # The pattern's part of Intersection.snapshot(). The phase position is not included:
+    # it follows from the intersection's step count.
+    def snapshot(self):
+        return dict(self.lights)
+
+    def restore(self, state):
+        self.lights = dict(state)
+
+    def step(self):
+        # Advance one step without blocking for a whole cycle.
+        self.lights.update(self.plan.lights_at(self.intersection.steps))
+        self.intersection.steps += 1
+        self.intersection.update_cars()
 
 class SimpleIntersection(TrafficPattern):
-    def __init__(self, intersection):
-        super().__init__(intersection)
+    def __init__(self, intersection, plan=None):
+        super().__init__(intersection, plan)
         self.lights = {
             "north": Light.RED, "south": Light.RED,
             "east": Light.GREEN, "west": Light.GREEN,
         }
 
-    def cycle(self):
-        self.lights.update({"north": Light.GREEN, "south": Light.GREEN, "east": Light.RED, "west": Light.RED})
-        if self._run_phase(10): return
-        self.lights.update({"north": Light.YELLOW, "south": Light.YELLOW})
-        if self._run_phase(3): return
-        self.lights.update({"north": Light.RED, "south": Light.RED, "east": Light.RED, "west": Light.RED})
-        if self._run_phase(2): return
-        self.lights.update({"east": Light.GREEN, "west": Light.GREEN, "north": Light.RED, "south": Light.RED})
-        if self._run_phase(10): return
-        self.lights.update({"east": Light.YELLOW, "west": Light.YELLOW})
-        if self._run_phase(3): return
-        self.lights.update({"north": Light.RED, "south": Light.RED, "east": Light.RED, "west": Light.RED})
-        if self._run_phase(2): return
+    PLAN = TimingPlan([
+        ({"north": Light.GREEN, "south": Light.GREEN, "east": Light.RED, "west": Light.RED}, 10),
+        ({"north": Light.YELLOW, "south": Light.YELLOW, "east": Light.RED, "west": Light.RED}, 3),
+        ({"north": Light.RED, "south": Light.RED, "east": Light.RED, "west": Light.RED}, 2),
+        ({"north": Light.RED, "south": Light.RED, "east": Light.GREEN, "west": Light.GREEN}, 10),
+        ({"north": Light.RED, "south": Light.RED, "east": Light.YELLOW, "west": Light.YELLOW}, 3),
+        ({"north": Light.RED, "south": Light.RED, "east": Light.RED, "west": Light.RED}, 2),
+    ], name="simple")
 
 class ProtectedLeftTurn(TrafficPattern):
-    def __init__(self, intersection):
-        super().__init__(intersection)
+    def __init__(self, intersection, plan=None):
+        super().__init__(intersection, plan)
         self.lights = {
             "north": Light.RED, "south": Light.RED,
             "east": Light.RED, "west": Light.RED,
         }
 
-    def cycle(self):
+    PLAN = TimingPlan([
         # --- North/South Cycle ---
-        self.lights.update({"north": Light.GREEN_ARROW, "south": Light.GREEN_ARROW, "east": Light.RED, "west": Light.RED})
-        if self._run_phase(5): return
-        self.lights.update({"north": Light.GREEN, "south": Light.GREEN})
-        if self._run_phase(8): return
-        self.lights.update({"north": Light.YELLOW, "south": Light.YELLOW})
-        if self._run_phase(3): return
-        self.lights.update({"north": Light.RED, "south": Light.RED, "east": Light.RED, "west": Light.RED})
-        if self._run_phase(2): return
-
+        ({"north": Light.GREEN_ARROW, "south": Light.GREEN_ARROW, "east": Light.RED, "west": Light.RED}, 5),
+        ({"north": Light.GREEN, "south": Light.GREEN, "east": Light.RED, "west": Light.RED}, 8),
+        ({"north": Light.YELLOW, "south": Light.YELLOW, "east": Light.RED, "west": Light.RED}, 3),
+        ({"north": Light.RED, "south": Light.RED, "east": Light.RED, "west": Light.RED}, 2),
         # --- East/West Cycle ---
-        self.lights.update({"east": Light.GREEN_ARROW, "west": Light.GREEN_ARROW, "north": Light.RED, "south": Light.RED})
-        if self._run_phase(5): return
-        self.lights.update({"east": Light.GREEN, "west": Light.GREEN})
-        if self._run_phase(8): return
-        self.lights.update({"east": Light.YELLOW, "west": Light.YELLOW})
-        if self._run_phase(3): return
-        self.lights.update({"north": Light.RED, "south": Light.RED, "east": Light.RED, "west": Light.RED})
-        if self._run_phase(2): return
+        ({"north": Light.RED, "south": Light.RED, "east": Light.GREEN_ARROW, "west": Light.GREEN_ARROW}, 5),
+        ({"north": Light.RED, "south": Light.RED, "east": Light.GREEN, "west": Light.GREEN}, 8),
+        ({"north": Light.RED, "south": Light.RED, "east": Light.YELLOW, "west": Light.YELLOW}, 3),
+        ({"north": Light.RED, "south": Light.RED, "east": Light.RED, "west": Light.RED}, 2),
+    ], name="protected-left")
+
+class ActuatedIntersection(TrafficPattern):
+    # Runs the phases of a plan in order, but sizes each green from live demand: a green
+    # lasts at least min_green steps, then ends once its approaches are empty (gap-out)
+    # or after max_green steps (max-out), and only if another approach is waiting; with
+    # no conflicting demand it rests in green. Yellow and all-red phases keep the plan's
+    # durations. Demand comes from the intersection's detectors, which are O(1) to read.
+    PLAN = SimpleIntersection.PLAN
+
+    def __init__(self, intersection, plan=None, min_green=4, max_green=20):
+        super().__init__(intersection, plan)
+        self.min_green, self.max_green = min_green, max_green
+        self.lights = {d: Light.RED for d in DIRECTIONS}
+        # Per phase: the approaches it serves (empty for yellow and all-red phases) and
+        # the approaches it holds at red.
+        self._served = []
+        for lights, _ in self.plan.phases:
+            served = [d for d in DIRECTIONS if lights[d] in (Light.GREEN, Light.GREEN_ARROW)]
+            self._served.append((served, [d for d in DIRECTIONS if d not in served]))
+        self.phase = 0
+        self.elapsed = 0 # steps the current phase has run
+
+    def phase_done(self):
+        served, waiting = self._served[self.phase]
+        if not served: return self.elapsed >= self.plan.phases[self.phase][1]
+        if self.elapsed < self.min_green: return False
+        count = self.intersection.approach_count
+        if not any(count(d) for d in waiting): return False
+        return self.elapsed >= self.max_green or not any(count(d) for d in served)
+
+    def step(self):
+        if self.phase_done():
+            self.phase = (self.phase + 1) % len(self.plan.phases)
+            self.elapsed = 0
+        self.lights.update(self.plan.phases[self.phase][0])
+        self.elapsed += 1
+        self.intersection.steps += 1
+        self.intersection.update_cars()
+
+    def cycle(self):
+        # Runs until the plan's last phase ends, so the next step starts the first one.
+        last = len(self.plan.phases) - 1
+        while not self.intersection.is_finished() and not (self.intersection.crash_detected and not self.intersection.ignore_crashes):
+            self.step()
+            if self.phase == last and self.phase_done(): break
+
+    def snapshot(self):
+        return dict(self.lights), self.phase, self.elapsed
+
+    def restore(self, state):
+        lights, self.phase, self.elapsed = state
+        self.lights = dict(lights)
 
 def get_light_parts(light_state, is_protected_turn=False):
     parts = []
@@ -201,209 +638,1836 @@ def get_light_parts(light_state, is_protected_turn=False):
         parts.append(LIGHT_SYMBOL[Light.GREEN] if light_state == Light.GREEN else LIGHT_SYMBOL["GREEN_UNLIT"])
     return parts
 
+@functools.lru_cache(maxsize=None)
+def _light_parts(light_state, is_protected_turn):
+    return tuple(get_light_parts(light_state, is_protected_turn))
+
+# What Intersection.run() yields after each step. `cars` holds (id, x, y, direction, stopped)
+# tuples, so a snapshot stays valid after the simulation moves on. `geometry` is None
+# for the default layout.
+Snapshot = collections.namedtuple("Snapshot", "step cars lights cars_created passed_cars goal_cars crashes pattern protected cleanup geometry",
+                                  defaults=(None,))
+
+class TerminalRenderer:
+    # Draws frames with ANSI cursor addressing. Only a viewport of the grid is shown
+    # (x, y, width, height in cells; by default the whole grid), so drawing costs follow
+    # the number of cars and the viewport size, never the size of the layout. The road
+    # layer is painted once per viewport; after that only cells whose glyph changed
+    # since the previous frame (lights, cars and the cells they vacated) are rewritten,
+    # all in a single buffered write.
+    def __init__(self, stream=None, viewport=None):
+        self.stream = stream or sys.stdout
+        self.viewport = viewport
+        self._front = None # dynamic cells currently on screen: (x, y) -> glyph
+        self._status = []
+        self._geometry = None
+        self.metrics = None # set to a Metrics to record time spent rendering
+
+    def scroll(self, dx, dy):
+        # Moves the viewport; the next frame repaints it.
+        if self.viewport is None: return
+        x, y, width, height = self.viewport
+        self.viewport = (x + dx, y + dy, width, height)
+        self._front = None
+
+    def render(self, frame):
+        if self.metrics is None: return self._render(frame)
+        start = time.perf_counter()
+        self._render(frame)
+        self.metrics.add_render_time(time.perf_counter() - start)
+
+    def _render(self, frame):
+        geometry = frame.geometry or DEFAULT_GEOMETRY
+        if geometry is not self._geometry:
+            if self._geometry is not None: self._front = None
+            self._geometry = geometry
+        if self.viewport is None: self.viewport = (0, 0, geometry.width, geometry.height)
+        vx, vy, width, height = self.viewport
+        back = {}
+        for (x, y), glyph in geometry.light_cells(frame.lights, frame.protected).items():
+            if vx <= x < vx + width and vy <= y < vy + height: back[(x, y)] = glyph
+        stopped, moving = f"{Color.RED}■{Color.RESET}", f"{Color.GREEN}■{Color.RESET}"
+        for _, x, y, _, is_stopped in frame.cars:
+            if vx <= x < vx + width and vy <= y < vy + height:
+                back[(x, y)] = stopped if is_stopped else moving
+        status = [f"Running pattern: {frame.pattern}"]
+        status.append("--------------")
+        status.append(f"Traffic Simulation v{VERSION} (Step: {frame.step})")
+        status.append(f"Cars Started: {frame.cars_created}/{frame.goal_cars}")
+        status.append(f"Cars Finished: {frame.passed_cars}/{frame.goal_cars}")
+        if frame.crashes > 0:
+            status.append(f"Crashes: {frame.crashes}")
+
+        out = []
+        road = geometry.road_glyph
+        if self._front is None:
+            out.append("\x1b[?25l\x1b[2J")
+            for y in range(vy, vy + height):
+                out.append(f"\x1b[{y - vy + 2};1H{''.join(road(x, y) for x in range(vx, vx + width))}")
+            self._front = {}
+            self._status = []
+        front = self._front
+        for cell, glyph in back.items():
+            if front.get(cell) != glyph:
+                out.append(f"\x1b[{cell[1] - vy + 2};{cell[0] - vx + 1}H{glyph}")
+        for cell in front.keys() - back.keys():
+            out.append(f"\x1b[{cell[1] - vy + 2};{cell[0] - vx + 1}H{road(*cell)}")
+        for i in range(max(len(status), len(self._status))):
+            line = status[i] if i < len(status) else ""
+            if i >= len(self._status) or self._status[i] != line:
+                row = 1 if i == 0 else height + 1 + i
+                out.append(f"\x1b[{row};1H{line}\x1b[K")
+        self._front = back
+        self._status = status
+        if out:
+            self.stream.write("".join(out))
+            self.stream.flush()
+
+    def close(self):
+        # Leave the cursor below the last frame and make it visible again.
+        if self._front is not None:
+            self.stream.write(f"\x1b[{self.viewport[3] + 1 + len(self._status)};1H\x1b[?25h")
+            self.stream.flush()
+
+def fit_viewport(geometry, size=None):
+    # A viewport centred on the intersection that fits a terminal of size (columns,
+    # lines), leaving room for the status lines; by default, the current terminal.
+    import shutil
+    columns, lines = size or shutil.get_terminal_size()
+    width, height = min(geometry.width, columns), min(geometry.height, max(1, lines - 8))
+    return (geometry.center - width // 2 if width < geometry.width else 0,
+            geometry.center - height // 2 if height < geometry.height else 0, width, height)
+
+class NumpyEngine:
+    # Vectorized replacement for Intersection._move_cars that owns the car state. The
+    # layout's routes are flattened into arrays indexed by route.base + position (cell,
+    # look-ahead cell, stop line, approach lane, on or off the grid), and each car is one
+    # row of `state`, kept in the order of Intersection.cars: its index into those
+    # arrays, wait, stopped flag, origin, entry step and id. Rows are added as cars enter
+    # and dropped as they leave, and occupancy is a persistent array over the grid, so a
+    # step is batched array operations end to end. The Car objects are only brought up
+    # to date when read (Intersection.cars, snapshots, drawing) or when a car leaves.
+    # Trajectories are identical to the reference engine for the same seed. The array
+    # calls cost about the same whatever the number of cars, so this only overtakes the
+    # reference engine beyond a few dozen cars, on layouts larger than the default one.
+    LIGHT_CODES = {Light.GREEN: 0, Light.GREEN_ARROW: 1, Light.YELLOW: 2, Light.RED: 3}
+    PAD = 3 # look-ahead reaches up to three cells past the grid edge
+    DENSE_CELLS = 1 << 20 # largest padded grid given an occupancy array
+    K, WAIT, STOPPED, ORIGIN, ENTERED, ID = range(6) # columns of `state`
+
+    def __init__(self, intersection):
+        global np
+        if np is None:
+            try:
+                import numpy as np
+            except ImportError:
+                raise ImportError("The numpy engine requires numpy to be installed.") from None
+        self.intersection = intersection
+        self.geometry = None
+        self.state = np.zeros((16, 6), np.int64)
+        self.n = 0
+        self.dirty = False # whether the Car objects are behind `state`
+        self._sorted = None # occupied cell numbers, sorted, on layouts too large for an occupancy array
+
+    def reset(self):
+        # Loads `state` from the intersection's cars after they have been assigned, and
+        # stands in for the intersection's cell index from then on (see __contains__).
+        intersection = self.intersection
+        if intersection.geometry is not self.geometry:
+            self.geometry = intersection.geometry
+            # Cells are numbered row by row over the padded grid. Occupancy is tested on a
+            # grid-sized array when that is small, and otherwise by looking cell numbers up
+            # in the sorted set of occupied ones, so large layouts need no such array.
+            self.stride = self.geometry.width + 2 * self.PAD
+            self.occupied = np.zeros(self.stride ** 2, dtype=bool) if self.stride ** 2 <= self.DENSE_CELLS else None
+            self.routes_seen = -1
+        self.build_tables()
+        cars = intersection._cars
+        self.n = n = len(cars)
+        self.state = np.zeros((max(16, 2 * n), 6), np.int64)
+        for i, car in enumerate(cars):
+            self.state[i] = (car.route.base + car.pos, car.wait, car.stopped, DIRECTIONS.index(car.origin), car.entered, car.id)
+        if self.occupied is not None:
+            self.occupied[:] = False
+            self.occupied[self.cell[self.state[:n, self.K]]] = True
+        self._sorted = None
+        self.dirty = False
+        return self
+
+    def build_tables(self):
+        # Rebuilt whenever cars have been put on routes the tables do not cover yet.
+        # Routes are only ever added, so the cars' indices stay valid.
+        routes = self.geometry.routes
+        if len(routes) == self.routes_seen: return
+        pad, stride = self.PAD, self.stride
+        cell_id = lambda cell: (cell[1] + pad) * stride + cell[0] + pad
+        cells = [c for r in routes for c in r.cells]
+        self.cell = np.array([cell_id(c) for c in cells], np.int64)
+        self.buffer = np.array([cell_id(c) for r in routes for c in r.buffers], np.int64)
+        self.at_stop = np.zeros(len(self.cell), dtype=bool)
+        self.at_stop[[r.base + r.stop for r in routes if r.stop >= 0]] = True
+        self.route_of = np.repeat(np.arange(len(routes)), [len(r.cells) for r in routes])
+        self.approach = np.array([DIRECTIONS.index(r.approach) for r in routes])
+        self.halts = np.array([[light in r.halts for light in self.LIGHT_CODES] for r in routes], dtype=bool)
+        # Per route index: the approach lane it is on (4 for none), and whether it is off the grid.
+        lanes = self.geometry.approach_cells
+        self.lane = np.array([DIRECTIONS.index(lanes[c]) if c in lanes else 4 for c in cells], np.int64)
+        self.off_grid = np.array([not self.geometry.contains(*c) for c in cells], dtype=bool)
+        self._must_stop = {} # lights -> whether a car at each route index must stop for them
+        # The move from each route position to the next as an id, and Geometry.conflicts
+        # as the sorted keys first * moves + second of its conflicting pairs (after a -1
+        # that never matches, so the array is never empty).
+        moves = {}
+        self.move = np.array([moves.setdefault(move, len(moves)) for r in routes for move in zip(r.cells, r.cells[1:] + [None])], np.int64)
+        self.moves = len(moves)
+        self.conflict_keys = np.unique(np.array([-1] + [moves[a] * self.moves + moves[b] for a, others in self.geometry.conflicts.items()
+                                                        for b in others], np.int64))
+        self.routes_seen = len(routes)
+
+    def must_stop(self, lights):
+        key = tuple(lights.values()) # patterns keep the lights in DIRECTIONS order
+        table = self._must_stop.get(key)
+        if table is None:
+            codes = np.array([self.LIGHT_CODES[lights[d]] for d in DIRECTIONS])
+            route = self.route_of
+            table = self._must_stop[key] = self.at_stop & self.halts[route, codes[self.approach[route]]]
+        return table
+
+    # The intersection's cell index while this engine runs it: `cell in engine`, get().
+    def _cell_id(self, cell):
+        return (cell[1] + self.PAD) * self.stride + cell[0] + self.PAD
+
+    def __contains__(self, cell):
+        if self.occupied is not None: return bool(self.occupied[self._cell_id(cell)])
+        if self._sorted is None: self._sorted = np.sort(self.cell[self.state[:self.n, self.K]])
+        i = bisect.bisect_left(self._sorted, self._cell_id(cell))
+        return i < len(self._sorted) and self._sorted[i] == self._cell_id(cell)
+
+    def __len__(self):
+        return len(np.unique(self.cell[self.state[:self.n, self.K]]))
+
+    def get(self, cell, default=None):
+        hits = np.flatnonzero(self.cell[self.state[:self.n, self.K]] == self._cell_id(cell))
+        if not len(hits): return default
+        self.sync()
+        return self.intersection._cars[hits[0]]
+
+    def add(self, car):
+        # A car that has just entered, appended to Intersection.cars by the caller.
+        self.build_tables()
+        if self.n == len(self.state): self.state = np.concatenate((self.state, np.zeros_like(self.state)))
+        self.state[self.n] = (car.route.base + car.pos, car.wait, car.stopped, DIRECTIONS.index(car.origin), car.entered, car.id)
+        self.n += 1
+        if self.occupied is not None: self.occupied[self._cell_id((car.x, car.y))] = True
+        else: self._sorted = None
+
+    def sync(self, rows=None):
+        # Brings the Car objects (or those at `rows`) up to date with `state`.
+        if rows is None:
+            if not self.dirty: return
+            self.dirty = False
+            cars, rows = self.intersection._cars, slice(0, self.n)
+        else:
+            cars = [self.intersection._cars[i] for i in rows.tolist()]
+        state = self.state[rows]
+        for car, k, wait, stopped in zip(cars, state[:, self.K].tolist(), state[:, self.WAIT].tolist(), state[:, self.STOPPED].tolist()):
+            route = car.route
+            car.pos = pos = k - route.base
+            car.x, car.y = route.cells[pos]
+            car.direction = route.headings[pos]; car.turn = route.turns[pos]
+            car.wait = wait
+            car.stopped = stopped == 1; car.color = Color.RED if stopped else Color.GREEN
+
+    def stop_all(self):
+        # After a crash: every car stops where it is.
+        self.state[:self.n, self.STOPPED] = 1
+        self.dirty = True
+
+    def move_cars(self):
+        # One step of movement. Updates the intersection's occupancy, detectors and
+        # queue counts, and removes the cars that left the grid, returning them.
+        intersection = self.intersection
+        n = self.n
+        if n == 0: return []
+        self.build_tables()
+        state = self.state[:n]
+        k = state[:, self.K]
+        cells, ahead, buffer = self.cell[k], self.cell[k + 1], self.buffer[k]
+        occupied = self.occupied
+        if occupied is not None:
+            is_car_ahead = occupied[ahead] | occupied[buffer]
+        else:
+            occupied = np.unique(cells)
+            lookups = np.concatenate((ahead, buffer))
+            found = occupied[np.minimum(np.searchsorted(occupied, lookups), len(occupied) - 1)] == lookups
+            is_car_ahead = found[:n] | found[n:]
+            self._sorted = None
+        moving = ~(is_car_ahead | self.must_stop(intersection.pattern.lights)[k])
+        accepted = self.resolve(k, moving)
+
+        moved = np.flatnonzero(accepted)
+        old = k[moved]
+        new = old + 1
+        state[moved, self.K] = new
+        if self.occupied is not None:
+            self.occupied[cells[moved]] = False
+            self.occupied[self.cell[new]] = True
+        stopped = ~accepted
+        state[:, self.STOPPED] = stopped
+        state[:, self.WAIT] += stopped
+        queued = np.bincount(state[stopped, self.ORIGIN], minlength=4).tolist()
+        left = np.bincount(self.lane[old], minlength=5).tolist()
+        entered = np.bincount(self.lane[new], minlength=5).tolist()
+        lane_count, lane_moving = intersection._lane_count, intersection._lane_moving
+        for i, d in enumerate(DIRECTIONS):
+            intersection.queued[d] = queued[i]
+            lane_count[d] += entered[i] - left[i]
+            lane_moving[d] += entered[i]
+        self.dirty = True
+
+        exiting = self.off_grid[new]
+        if not exiting.any(): return []
+        rows = moved[exiting]
+        if self.occupied is not None: self.occupied[self.cell[new[exiting]]] = False
+        self.sync(rows)
+        cars = intersection._cars
+        exited = [cars[i] for i in rows.tolist()]
+        keep = np.ones(n, dtype=bool); keep[rows] = False
+        intersection._cars = list(itertools.compress(cars, keep.tolist()))
+        self.n = n - len(rows)
+        self.state[:self.n] = state[keep]
+        return exited
+
+    def resolve(self, k, moving):
+        # Intersection._resolve_moves on arrays: which of the cars at route indices `k`
+        # make their next move, given which of them want to. Of cars heading for one cell
+        # the one with right of way gets it; a car entering a cell another leaves in a
+        # conflicting move (looked up in Geometry.conflicts) stays put; so does a car
+        # entering the cell of a car held back, and so on along the queue. Every car
+        # held back counts as a crash. The movement rules only let cars into cells that
+        # are free at the start of a step, so the swap and queue checks are skipped when
+        # no car is heading for an occupied cell.
+        intersection = self.intersection
+        accepted = np.zeros(len(k), dtype=bool)
+        movers = np.flatnonzero(moving)
+        if not len(movers): return accepted
+        cells, ahead = self.cell[k], self.cell[k + 1]
+        wanting = len(movers)
+        target = np.sort(ahead[movers])
+        held_cells = cells[:0]
+        if (target[1:] == target[:-1]).any():
+            state = self.state[:len(k)]
+            movers = movers[np.lexsort((cells[movers], state[movers, self.ID], state[movers, self.ENTERED]))]
+            _, first = np.unique(ahead[movers], return_index=True)
+            lost = np.ones(wanting, dtype=bool); lost[first] = False
+            held_cells = cells[movers[lost]]
+            movers = movers[first]
+        source, target = cells[movers], ahead[movers]
+        keep = np.ones(len(movers), dtype=bool)
+        if self.occupied is None or self.occupied[target].any() or len(held_cells):
+            order = np.argsort(source)
+            other = order[np.minimum(np.searchsorted(source[order], target), len(order) - 1)]
+            follows = source[other] == target
+            if follows.any():
+                pairs = self.move[k[movers]] * self.moves + self.move[k[movers[other]]]
+                keys = self.conflict_keys
+                crossing = follows & (keys[np.minimum(np.searchsorted(keys, pairs), len(keys) - 1)] == pairs)
+                keep &= ~crossing
+                held_cells = np.concatenate((held_cells, source[crossing]))
+            while len(held_cells):
+                following = keep & np.isin(target, held_cells)
+                keep &= ~following
+                held_cells = source[following]
+        accepted[movers[keep]] = True
+        crashes = wanting - int(keep.sum())
+        if crashes:
+            intersection.crashes += crashes
+            intersection.crash_detected = True
+        return accepted
+
+ENGINES = {'python': None, 'numpy': NumpyEngine}
+
+class JsonlSink:
+    # Writes every metrics record as one JSON object per line.
+    def __init__(self, stream):
+        import json
+        self.stream = stream
+        self.encode = json.JSONEncoder(separators=(",", ":")).encode
+
+    def write(self, record):
+        self.stream.write(self.encode(record) + "\n")
+
+class CsvSink:
+    # Writes one kind of metrics record ("step" or "car") as CSV rows.
+    FIELDS = {
+        "step": ["step", "passed", "crashes", "on_grid", "phase"] + [f"queue_{d}" for d in DIRECTIONS],
+        "car": ["step", "id", "origin", "wait", "travel"],
+    }
+
+    def __init__(self, stream, kind="step"):
+        import csv
+        self.kind = kind
+        self.writer = csv.DictWriter(stream, self.FIELDS[kind], extrasaction="ignore")
+        self.writer.writeheader()
+
+    def write(self, record):
+        if record["type"] != self.kind: return
+        if self.kind == "step":
+            record = dict(record, **{f"queue_{d}": n for d, n in record["queue"].items()})
+        self.writer.writerow(record)
+
+def phase_name(lights):
+    return "/".join(light.value for light in lights)
+
+class Metrics:
+    # Instrumentation for one Intersection: queue length per approach (stopped cars, by
+    # the approach they came from), per-car wait and travel time, steps spent in each
+    # signal state, and wall-clock time in update_cars versus rendering. Aggregates are
+    # fixed-size counters; per-step and per-car records only go to sinks when there are
+    # any. update_cars is timed on one step in `timing_every` so it can stay on in batch runs.
+    def __init__(self, sinks=(), timing_every=16):
+        self.sinks = list(sinks)
+        self.timing_every = max(1, timing_every)
+        self.steps = 0
+        self.queue = {d: 0 for d in DIRECTIONS}
+        self.queue_sum = {d: 0 for d in DIRECTIONS}
+        self.queue_max = {d: 0 for d in DIRECTIONS}
+        self.wait = [0, 0, 0] # count, total, max
+        self.travel = [0, 0, 0]
+        self.phase_steps = {} # tuple of Lights (in DIRECTIONS order) -> steps
+        self.update_seconds = 0.0
+        self.update_samples = 0
+        self.render_seconds = 0.0
+        self.render_samples = 0
+
+    def should_time(self):
+        return self.steps % self.timing_every == 0
+
+    def add_update_time(self, seconds):
+        self.update_seconds += seconds; self.update_samples += 1
+
+    def add_render_time(self, seconds):
+        self.render_seconds += seconds; self.render_samples += 1
+
+    def record_step(self, intersection):
+        self.steps += 1
+        self.queue = queue = intersection.queued # kept by the intersection as cars stop
+        for d, n in queue.items():
+            self.queue_sum[d] += n
+            if n > self.queue_max[d]: self.queue_max[d] = n
+        phase = tuple(intersection.pattern.lights.values()) # patterns keep the lights in DIRECTIONS order
+        self.phase_steps[phase] = self.phase_steps.get(phase, 0) + 1
+        if self.sinks:
+            record = {"type": "step", "step": intersection.steps, "passed": intersection.passed_cars,
+                      "crashes": intersection.crashes, "on_grid": intersection.on_grid,
+                      "phase": phase_name(phase), "queue": dict(queue)}
+            for sink in self.sinks: sink.write(record)
+
+    def record_exit(self, car, step):
+        travel = step - car.entered
+        for stats, value in ((self.wait, car.wait), (self.travel, travel)):
+            stats[0] += 1; stats[1] += value
+            if value > stats[2]: stats[2] = value
+        if self.sinks:
+            record = {"type": "car", "step": step, "id": car.id, "origin": car.origin, "wait": car.wait, "travel": travel}
+            for sink in self.sinks: sink.write(record)
+
+    def summary(self):
+        steps = self.steps or 1
+        mean = lambda stats: stats[1] / stats[0] if stats[0] else 0.0
+        return {
+            "steps": self.steps,
+            "queue_mean": {d: total / steps for d, total in self.queue_sum.items()},
+            "queue_max": dict(self.queue_max),
+            "wait": {"cars": self.wait[0], "mean": mean(self.wait), "max": self.wait[2]},
+            "travel": {"cars": self.travel[0], "mean": mean(self.travel), "max": self.travel[2]},
+            "phase_occupancy": {phase_name(phase): n / steps for phase, n in self.phase_steps.items()},
+            # Sampled timings, scaled up to an estimate for every step / frame.
+            "update_seconds": self.update_seconds / self.update_samples * self.steps if self.update_samples else 0.0,
+            "render_seconds": self.render_seconds,
+        }
+
+    def prometheus(self, intersection=None, prefix="traffic"):
+        # The current values in Prometheus text exposition format.
+        lines = []
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in samples:
+                label_text = "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}" if labels else ""
+                lines.append(f"{prefix}_{name}{label_text} {value}")
+        metric("steps_total", "counter", "Simulation steps recorded.", [({}, self.steps)])
+        if intersection is not None:
+            metric("cars_created_total", "counter", "Cars that entered the grid.", [({}, intersection.cars_created)])
+            metric("cars_passed_total", "counter", "Cars that left the grid.", [({}, intersection.passed_cars)])
+            metric("crashes_total", "counter", "Crashes detected.", [({}, intersection.crashes)])
+        metric("queue_length", "gauge", "Stopped cars per approach at the last step.", [({"approach": d}, n) for d, n in self.queue.items()])
+        metric("queue_length_steps_total", "counter", "Queue length per approach summed over steps.", [({"approach": d}, n) for d, n in self.queue_sum.items()])
+        for name, stats, help_text in (("car_wait_steps", self.wait, "Steps each car spent stopped."),
+                                        ("car_travel_steps", self.travel, "Steps from entering to leaving the grid.")):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} summary")
+            lines.append(f"{prefix}_{name}_sum {stats[1]}")
+            lines.append(f"{prefix}_{name}_count {stats[0]}")
+        metric("phase_steps_total", "counter", "Steps spent in each signal state (north/south/east/west).",
+               [({"phase": phase_name(phase)}, n) for phase, n in self.phase_steps.items()])
+        metric("update_seconds_sampled_total", "counter", "Wall-clock seconds in update_cars, over sampled steps.", [({}, self.update_seconds)])
+        metric("update_samples_total", "counter", "Steps whose update_cars time was sampled.", [({}, self.update_samples)])
+        metric("render_seconds_total", "counter", "Wall-clock seconds spent rendering.", [({}, self.render_seconds)])
+        metric("render_frames_total", "counter", "Frames rendered.", [({}, self.render_samples)])
+        return "\n".join(lines) + "\n"
+
+class RunningStats:
+    # Count, mean and variance (Welford's method), min and max of a stream, in O(1) memory.
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = self.max = None
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min: self.min = value
+        if self.max is None or value > self.max: self.max = value
+
+    @property
+    def variance(self):
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+class P2Quantile:
+    # Streaming estimate of the p-quantile from five markers (the P-square algorithm of
+    # Jain and Chlamtac), so memory does not grow with the stream.
+    def __init__(self, p):
+        self.p = p
+        self.heights = [] # the first five values, then the marker heights
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, value):
+        q, n = self.heights, self.positions
+        if len(q) < 5:
+            bisect.insort(q, value)
+            return
+        if value < q[0]: q[0] = value
+        elif value > q[4]: q[4] = value
+        k = min(3, max(0, bisect.bisect_right(q, value) - 1)) # the cell the value falls in
+        for i in range(k + 1, 5): n[i] += 1
+        for i in range(5): self.desired[i] += self.increments[i]
+        for i in (1, 2, 3):
+            delta = self.desired[i] - n[i]
+            if (delta >= 1 and n[i + 1] - n[i] > 1) or (delta <= -1 and n[i - 1] - n[i] < -1):
+                s = 1 if delta > 0 else -1
+                height = q[i] + s / (n[i + 1] - n[i - 1]) * ((n[i] - n[i - 1] + s) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                                                           + (n[i + 1] - n[i] - s) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < height < q[i + 1]: # the parabola overshoots; fall back to linear
+                    height = q[i] + s * (q[i + s] - q[i]) / (n[i + s] - n[i])
+                q[i] = height; n[i] += s
+
+    def value(self):
+        q = self.heights
+        if len(q) < 5: return q[min(len(q) - 1, int(self.p * len(q)))] if q else None
+        return q[2]
+
+class BatchMeans:
+    # Confidence interval for the mean of a correlated series (cars finishing per step,
+    # or waits in the order cars leave) by the method of batch means, in fixed memory:
+    # values are summed into at most 2 * `batches` batches, and when those fill up
+    # neighbouring batches are merged and the batch size doubles, so batches keep getting
+    # longer than the correlation in the series.
+    def __init__(self, batches=32):
+        self.batches = batches
+        self.size = 1
+        self.sums = []
+        self.count = 0
+        self.total = 0.0
+        self._partial = 0.0
+        self._in_partial = 0
+
+    def add(self, value):
+        self.count += 1; self.total += value
+        self._partial += value; self._in_partial += 1
+        if self._in_partial == self.size:
+            self.sums.append(self._partial)
+            self._partial = 0.0; self._in_partial = 0
+            if len(self.sums) == 2 * self.batches:
+                self.sums = [a + b for a, b in zip(self.sums[::2], self.sums[1::2])]
+                self.size *= 2
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def half_width(self, confidence=0.95):
+        # Half-width of the interval around the mean, or None until there are `batches`
+        # complete batches. Student's t is approximated from the normal quantile.
+        k = len(self.sums)
+        if k < self.batches: return None
+        means = [total / self.size for total in self.sums]
+        center = sum(means) / k
+        variance = sum((m - center) ** 2 for m in means) / (k - 1)
+        from statistics import NormalDist
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        t = z + (z ** 3 + z) / (4 * (k - 1))
+        return t * math.sqrt(variance / k)
+
+class SteadyState(Metrics):
+    # Metrics for long runs. On top of the Metrics counters it ignores the first
+    # `warmup` steps, then keeps streaming estimates, in fixed memory: wait time
+    # (mean, variance and quantiles), travel time, and cars finishing per step overall
+    # and by approach, with batch-means confidence intervals on throughput and mean wait.
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, warmup=0, sinks=(), timing_every=16, batches=32):
+        super().__init__(sinks, timing_every)
+        self.warmup = warmup
+        self.observed_steps = 0
+        self.wait_time = RunningStats()
+        self.wait_quantiles = {p: P2Quantile(p) for p in self.QUANTILES}
+        self.wait_means = BatchMeans(batches)
+        self.travel_time = RunningStats()
+        self.throughput = BatchMeans(batches)
+        self.approach_throughput = {d: BatchMeans(batches) for d in DIRECTIONS}
+        self._finished = {d: 0 for d in DIRECTIONS} # by approach, in the current step
+        self.stalled = 0 # consecutive steps in which every car on the grid was stopped
+        self._held = 0 # steps of the current stall not yet added to the estimates
+
+    def record_step(self, intersection):
+        super().record_step(intersection)
+        self.stalled = self.stalled + 1 if intersection.on_grid and sum(self.queue.values()) == intersection.on_grid else 0
+        if intersection.steps <= self.warmup: return
+        finished = self._finished
+        total = sum(finished.values())
+        # Steps in which nothing moves or finishes are held back until something moves
+        # again, so a run that ends in gridlock leaves its dead steps out of the estimates.
+        if self.stalled and not total:
+            self._held += 1
+            return
+        for _ in range(self._held): self._observe(0, None)
+        self._held = 0
+        self._observe(total, finished)
+        for d in finished: finished[d] = 0
+
+    def _observe(self, total, finished):
+        self.observed_steps += 1
+        self.throughput.add(total)
+        for d, estimate in self.approach_throughput.items(): estimate.add(finished[d] if finished else 0)
+
+    def record_exit(self, car, step):
+        super().record_exit(car, step)
+        if step <= self.warmup: return
+        self.wait_time.add(car.wait)
+        self.wait_means.add(car.wait)
+        for quantile in self.wait_quantiles.values(): quantile.add(car.wait)
+        self.travel_time.add(step - car.entered)
+        self._finished[car.origin] += 1
+
+    def converged(self, precision, confidence=0.95):
+        # Whether throughput and mean wait are both known to within `precision` (relative).
+        for estimate in (self.throughput, self.wait_means):
+            half_width = estimate.half_width(confidence)
+            if half_width is None or half_width > precision * abs(estimate.mean): return False
+        return True
+
+    def report(self, confidence=0.95):
+        interval = lambda estimate: {"mean": estimate.mean or 0.0, "ci": estimate.half_width(confidence)}
+        return {
+            "warmup": self.warmup,
+            "steps": self.observed_steps,
+            "confidence": confidence,
+            "throughput": dict(interval(self.throughput), approaches={d: interval(b) for d, b in self.approach_throughput.items()}),
+            "wait": dict(interval(self.wait_means), cars=self.wait_time.count, std=self.wait_time.std, max=self.wait_time.max,
+                         quantiles={f"p{round(p * 100)}": q.value() for p, q in self.wait_quantiles.items()}),
+            "travel": {"cars": self.travel_time.count, "mean": self.travel_time.mean, "std": self.travel_time.std, "max": self.travel_time.max},
+        }
+
+    def summary(self):
+        return dict(super().summary(), steady_state=self.report())
+
 class Intersection:
-    def __init__(self, concurrent_cars, goal_cars, pattern_class, is_test_mode=False, left_turn_percentage=None, distribution_factor=1.0, ignore_crashes=False):
+    def __init__(self, concurrent_cars, goal_cars, pattern_class, is_test_mode=False, left_turn_percentage=None, distribution_factor=1.0, ignore_crashes=False, engine='python', approaches=None, timing_plan=None, arrival_rate=None, metrics=None, seed=None, geometry=None, max_steps=MAX_STEPS):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}; choose from {', '.join(ENGINES)}.")
+        self.geometry = geometry or DEFAULT_GEOMETRY
+        self._own_geometry = False # set once cars placed by hand need routes of their own
+        self._engine = ENGINES[engine](self) if ENGINES[engine] else None
         self.cars = []
         self.passed_cars = 0
         self.concurrent_cars = concurrent_cars
         self.goal_cars = goal_cars
+        self.max_steps = max_steps
         self.cars_created = 0
-        self.grid = [[" " for _ in range(GRID_WIDTH)] for _ in range(GRID_HEIGHT)]
-        self.pattern = pattern_class(self)
+        self.grid = None # dense drawing of the grid, built by update_grid() on request
+        self.renderer = None
+        self.pattern = pattern_class(self, plan=timing_plan)
         self.is_test_mode = is_test_mode
         self.steps = 0
+        self.cleanup_steps = 0 # steps run() took after the signals stopped, not counted in `steps`
         self.crashes = 0
         self.crash_detected = False
         self.left_turn_percentage = left_turn_percentage
         self.distribution_factor = distribution_factor
         self.ignore_crashes = ignore_crashes
-        self._spawn_direction_pool = []
-        self._generate_spawn_pool()
+        self.wait_stats = {d: [0, 0, 0] for d in DIRECTIONS} # count, total, max
+        self.approaches = list(DIRECTIONS if approaches is None else approaches) # directions new cars spawn from
+        self.exits = None # set to a list to collect cars as they leave the grid
+        self.metrics = metrics
+        # All of this simulation's randomness comes from its own generator, so runs are
+        # reproducible and independent of each other. Without a seed, one is drawn from
+        # the global random module (so random.seed() still makes a run repeatable).
+        self.rng = random.Random(random.getrandbits(64) if seed is None else seed)
+        self.arrival_rate = arrival_rate
+        self.arrivals = ArrivalProcess(self.approaches, distribution_factor, arrival_rate, goal_cars, self.rng)
+        self.pending = {d: 0 for d in self.approaches} # cars that have arrived but not yet entered, per approach
+        self._pending_total = 0
+        self._next_approach = 0
+        self._next_lane = {d: 0 for d in DIRECTIONS}
+        self._lane_moving = {d: 0 for d in DIRECTIONS} # cars that moved onto or along each approach lane this step
+        self.queued = {d: 0 for d in DIRECTIONS} # cars stopped after the last step, by the approach they came from
         if not is_test_mode:
             for _ in range(self.concurrent_cars):
                 self.spawn_car()
 
-    def _generate_spawn_pool(self):
-        directions = ["north", "south", "east", "west"]
-        pool = []
-        
-        num_even_cars = round(self.goal_cars * self.distribution_factor)
-        num_random_cars = self.goal_cars - num_even_cars
-
-        # Add evenly distributed cars
-        for i in range(num_even_cars):
-            pool.append(directions[i % 4])
-        
-        # Add randomly distributed cars
-        if num_random_cars > 0:
-            random_direction = random.choice(directions)
-            for _ in range(num_random_cars):
-                pool.append(random_direction)
-        
-        random.shuffle(pool)
-        self._spawn_direction_pool = pool
-
     def is_finished(self):
-        return self.passed_cars >= self.goal_cars or self.steps >= MAX_STEPS or (self.crashes > 0 and not self.ignore_crashes)
+        # goal_cars and max_steps may be None for no limit.
+        return (self.goal_cars is not None and self.passed_cars >= self.goal_cars) or \
+               (self.max_steps is not None and self.steps >= self.max_steps) or (self.crashes > 0 and not self.ignore_crashes)
+
+    def add_arrivals(self, directions):
+        for direction in directions:
+            self.pending[direction] += 1
+        self._pending_total += len(directions)
 
     def spawn_car(self):
-        if len(self.cars) >= self.concurrent_cars or not self._spawn_direction_pool or self.crash_detected:
+        # Lets one waiting car onto the grid, trying each approach's queue in turn from
+        # where the last spawn left off. Without an arrival rate, a car is drawn from the
+        # arrival stream whenever nobody is waiting.
+        if len(self._cars) >= self.concurrent_cars or self.crash_detected:
+            return
+        if not self._pending_total and self.arrival_rate is None:
+            direction = self.arrivals.next()
+            if direction is None: return
+            self.add_arrivals((direction,))
+        if not self._pending_total:
             return
 
-        direction = self._spawn_direction_pool[-1]
-        temp_car = Car(self.cars_created, direction)
-        if any(c.x == temp_car.x and c.y == temp_car.y for c in self.cars):
-            random.shuffle(self._spawn_direction_pool)
+        approaches = self.approaches
+        entry_cells = self.geometry.entry_cells; single_lane = self.geometry.lanes == 1
+        for i in range(len(approaches)):
+            direction = approaches[(self._next_approach + i) % len(approaches)]
+            if not self.pending[direction]: continue
+            if single_lane: lane = None if entry_cells[direction][0] in self._occupancy else 0 # saves a call per approach
+            else: lane = self._free_lane(direction)
+            if lane is not None: break
+        else:
             return
+        self._next_approach = (self._next_approach + i + 1) % len(approaches)
+        self._next_lane[direction] = (lane + 1) % self.geometry.lanes
+        self.pending[direction] -= 1
+        self._pending_total -= 1
+        new_car = Car(self.cars_created, direction, self.choose_turn(), lane, self.geometry)
+        new_car.entered = self.steps
+        self._place(new_car)
+        self.cars_created += 1
+
+    def _free_lane(self, direction):
+        # The first lane, from the one after the last used, whose entry cell is free.
+        entries = self.geometry.entry_cells[direction]
+        for i in range(len(entries)):
+            lane = (self._next_lane[direction] + i) % len(entries)
+            if entries[lane] not in self._occupancy: return lane
+        return None
 
-        self._spawn_direction_pool.pop()
-        turn = None
+    def choose_turn(self):
         if isinstance(self.pattern, ProtectedLeftTurn):
-            if self.left_turn_percentage and random.random() < self.left_turn_percentage:
-                turn = "left"
-        
-        new_car = Car(self.cars_created, direction, turn)
-        self.cars.append(new_car)
-        self.cars_created += 1
+            if self.left_turn_percentage and self.rng.random() < self.left_turn_percentage:
+                return "left"
+        return None
+
+    def admit_car(self, car):
+        # Places a car arriving from outside (e.g. a neighbouring intersection) at a free
+        # entry cell of its approach. Returns False, leaving the car with the caller, if
+        # every lane's entry cell is taken.
+        if self.crash_detected and not self.ignore_crashes: return False
+        lane = self._free_lane(car.direction)
+        if lane is None: return False
+        self._next_lane[car.direction] = (lane + 1) % self.geometry.lanes
+        car.x, car.y = self.geometry.entry_cells[car.direction][lane]
+        car.route, car.pos = self.geometry.route(car.direction, car.turn, car.x, car.y)
+        car.entered = self.steps
+        self._place(car)
+        return True
+
+    def _place(self, car):
+        # Puts a car that has just entered at its entry cell, and on its approach lane.
+        self._cars.append(car)
+        if self._engine is not None: self._engine.add(car)
+        else: self._occupancy[(car.x, car.y)] = car
+        self._lane_count[car.direction] += 1; self._lane_moving[car.direction] += 1
+
+    def snapshot(self):
+        # A copy of the full simulation state (cars, lights, RNG, queues and counters) that
+        # restore() can return this intersection, or a fork() of it, to. Not to be confused
+        # with step_snapshot(), the lightweight read-only view used for drawing.
+        return {
+            "cars": [copy.copy(car) for car in self.cars],
+            "lights": self.pattern.snapshot(),
+            "rng": self.rng.getstate(),
+            "arrivals_remaining": self.arrivals.remaining,
+            "pending": dict(self.pending),
+            "lane_moving": dict(self._lane_moving),
+            "counters": (self.steps, self.passed_cars, self.cars_created, self.crashes, self.crash_detected,
+                         self._pending_total, self._next_approach),
+            "next_lane": dict(self._next_lane),
+            "wait_stats": {d: list(stats) for d, stats in self.wait_stats.items()},
+        }
+
+    def restore(self, state):
+        self.cars = [copy.copy(car) for car in state["cars"]]
+        self.pattern.restore(state["lights"])
+        self.rng.setstate(state["rng"])
+        self.arrivals.remaining = state["arrivals_remaining"]
+        self.pending = dict(state["pending"])
+        self._lane_moving = dict(state["lane_moving"])
+        (self.steps, self.passed_cars, self.cars_created, self.crashes, self.crash_detected,
+         self._pending_total, self._next_approach) = state["counters"]
+        self._next_lane = dict(state["next_lane"])
+        self.wait_stats = {d: list(stats) for d, stats in state["wait_stats"].items()}
+
+    def fork(self, seed=None):
+        # An independent copy of this intersection in its current state, for branching
+        # what-if runs off one warmed-up simulation. With a seed the fork's RNG is
+        # reseeded, so branches see different traffic from here on; without one it
+        # continues exactly as this intersection would. Renderer and metrics are not copied.
+        fork = copy.copy(self)
+        fork.rng = random.Random()
+        fork.arrivals = copy.copy(self.arrivals)
+        fork.arrivals.rng = fork.rng
+        fork.pattern = copy.copy(self.pattern)
+        fork.pattern.intersection = fork
+        fork._engine = type(self._engine)(fork) if self._engine else None
+        fork.grid = None
+        fork.renderer = None
+        fork.metrics = None
+        fork.exits = [] if self.exits is not None else None
+        fork.restore(self.snapshot())
+        if seed is not None: fork.rng.seed(seed)
+        return fork
+
+    # Cars are indexed by cell so lookups are O(1). Assigning to `cars` rebuilds the
+    # index and puts cars moved by hand back on a route; cars moved by hand after that
+    # need a fresh assignment to be seen. The numpy engine keeps the cars' state in its
+    # own arrays and brings the Car objects up to date when `cars` is read.
+    @property
+    def cars(self):
+        if self._engine is not None and self._engine.dirty: self._engine.sync()
+        return self._cars
+
+    @property
+    def on_grid(self):
+        # The number of cars on the grid, without bringing them up to date.
+        return len(self._cars)
+
+    @cars.setter
+    def cars(self, cars):
+        if not self._own_geometry and not all(self.geometry.has_route(car) for car in cars):
+            # Routes traced for cars off the built ones go on this intersection's own
+            # copy of the layout, leaving the one other intersections share untouched.
+            self.geometry = self.geometry.copy(); self._own_geometry = True
+        self._cars = cars
+        self._occupancy = {}
+        for car in cars:
+            self.geometry.anchor(car)
+            self._occupancy.setdefault((car.x, car.y), car)
+        self._lane_count = {d: 0 for d in DIRECTIONS}
+        approach_cells = self.geometry.approach_cells
+        for cell in self._occupancy:
+            if cell in approach_cells: self._lane_count[approach_cells[cell]] += 1
+        if self._engine is not None: self._occupancy = self._engine.reset()
+
+    # Detectors for signal control, kept up to date as cars enter, move and leave, so
+    # reading them never scans the cars. A car on an approach lane that did not move in
+    # the last step is queued; cars move or stop all at once, so that is every car on
+    # the lane minus those that moved there (or entered) this step.
+    def approach_count(self, approach):
+        return self._lane_count[approach]
+
+    def queue_length(self, approach):
+        return self._lane_count[approach] - self._lane_moving[approach]
+
+    def stop_line_occupied(self, approach):
+        # Whether a car is waiting at the stop line in any of the approach's lanes.
+        return any(cell in self._occupancy for cell in self.geometry.stop_line_cells[approach])
+
+    def _moved(self, old_cell, new_cell):
+        # Detector bookkeeping for a car moving between cells; engines call this for
+        # every car that moved.
+        lane_count = self._lane_count
+        approach_cells = self.geometry.approach_cells
+        approach = approach_cells.get(old_cell)
+        if approach: lane_count[approach] -= 1
+        approach = approach_cells.get(new_cell)
+        if approach: lane_count[approach] += 1; self._lane_moving[approach] += 1
 
     def get_car_at(self, x, y):
-        return next((car for car in self.cars if car.x == x and car.y == y), None)
+        return self._occupancy.get((x, y))
 
-    def update_grid(self):
-        self.grid = [[" " for _ in range(GRID_WIDTH)] for _ in range(GRID_HEIGHT)]
-        for i in range(GRID_HEIGHT):
-            self.grid[i][LANE_S_X] = "║"; self.grid[i][LANE_N_X] = "║"
-        for i in range(GRID_WIDTH):
-            self.grid[LANE_E_Y][i] = "═"; self.grid[LANE_W_Y][i] = "═"
-        self.grid[LANE_E_Y][LANE_S_X] = "╬"; self.grid[LANE_E_Y][LANE_N_X] = "╬"
-        self.grid[LANE_W_Y][LANE_S_X] = "╬"; self.grid[LANE_W_Y][LANE_N_X] = "╬"
-
-        is_protected = isinstance(self.pattern, ProtectedLeftTurn)
-        light_parts_s = get_light_parts(self.pattern.lights['south'], is_protected)
-        for i, p in enumerate(light_parts_s): self.grid[INTERSECTION_START_Y - 1 - i][LANE_S_X - 2] = p
-        light_parts_n = get_light_parts(self.pattern.lights['north'], is_protected)
-        for i, p in enumerate(light_parts_n): self.grid[INTERSECTION_END_Y + 1 + i][LANE_N_X + 2] = p
-        light_parts_e = get_light_parts(self.pattern.lights['east'], is_protected)
-        self.grid[LANE_W_Y + 2][INTERSECTION_START_X - 1 - len(light_parts_e) : INTERSECTION_START_X - 1] = light_parts_e
-        light_parts_w = get_light_parts(self.pattern.lights['west'], is_protected)
-        self.grid[LANE_E_Y - 2][INTERSECTION_END_X + 2 : INTERSECTION_END_X + 2 + len(light_parts_w)] = light_parts_w
+    def light_cells(self):
+        return self.geometry.light_cells(self.pattern.lights, isinstance(self.pattern, ProtectedLeftTurn))
 
+    def update_grid(self):
+        self.grid = [list(row) for row in self.geometry.road_rows()]
+        for (x, y), glyph in self.light_cells().items():
+            self.grid[y][x] = glyph
         for car in self.cars:
-            if 0 <= car.y < GRID_HEIGHT and 0 <= car.x < GRID_WIDTH:
+            if self.geometry.contains(car.x, car.y):
                 self.grid[car.y][car.x] = repr(car)
 
     def print_state(self):
-        os.system('clear' if os.name != 'nt' else 'cls')
-        self.update_grid()
-        print(f"Running pattern: {self.pattern.__class__.__name__}")
-        for row in self.grid: print("".join(row))
-        print("--------------")
-        print(f"Traffic Simulation v{VERSION} (Step: {self.steps})")
-        print(f"Cars Started: {self.cars_created}/{self.goal_cars}")
-        print(f"Cars Finished: {self.passed_cars}/{self.goal_cars}")
-        if self.crashes > 0:
-            print(f"Crashes: {self.crashes}")
+        if self.renderer is None:
+            self.renderer = TerminalRenderer()
+        self.renderer.render(self.step_snapshot())
+
+    def step_snapshot(self, cleanup=False):
+        return Snapshot(self.steps, tuple((car.id, car.x, car.y, car.direction, car.stopped) for car in self.cars),
+                        dict(self.pattern.lights), self.cars_created, self.passed_cars, self.goal_cars, self.crashes,
+                        self.pattern.__class__.__name__, isinstance(self.pattern, ProtectedLeftTurn), cleanup,
+                        None if self.geometry == DEFAULT_GEOMETRY else self.geometry)
+
+    def run(self, cleanup_steps=CLEANUP_STEPS, snapshots=True):
+        # Steps the simulation to the end, yielding a Snapshot after every step (or None
+        # with snapshots=False): signal-timed steps until is_finished(), then up to
+        # cleanup_steps + 1 more steps (None: as many as it takes) to let the remaining cars
+        # clear the grid. Drawing and pacing are left to the consumer; see RealTime,
+        # FastForward and unpaced.
+        while not self.is_finished():
+            self.pattern.step()
+            yield self.step_snapshot() if snapshots else None
+        cleanup = 0
+        while self._cars and (cleanup_steps is None or cleanup <= cleanup_steps):
+            self.update_cars()
+            cleanup += 1
+            self.cleanup_steps += 1
+            yield self.step_snapshot(cleanup=True) if snapshots else None
 
     def update_cars(self):
+        metrics = self.metrics
+        if metrics is None:
+            self._update_cars()
+        elif metrics.should_time():
+            start = time.perf_counter()
+            self._update_cars()
+            metrics.add_update_time(time.perf_counter() - start)
+            metrics.record_step(self)
+        else:
+            self._update_cars()
+            metrics.record_step(self)
+
+    def _update_cars(self):
+        for d in self._lane_moving: self._lane_moving[d] = 0
+        self.queued = queued = {d: 0 for d in DIRECTIONS} # counted where cars stop, so metrics need not scan the cars
         if self.crash_detected and not self.ignore_crashes:
+            if self._engine is not None: self._engine.stop_all()
             for car in self.cars:
                 car.stopped = True
                 car.color = Color.RED
+                queued[car.origin] += 1
             return
 
-        intended_moves = {}
-        for car in self.cars:
+        if self._engine is not None:
+            exited = self._engine.move_cars()
+            for car in exited: self._record_exit(car)
+            self.passed_cars += len(exited)
+        else:
+            self._move_cars()
+            occupancy = self._occupancy
+            cars_on_grid = []
+            width, height = self.geometry.width, self.geometry.height
+            for car in self._cars:
+                if 0 <= car.x < width and 0 <= car.y < height: cars_on_grid.append(car)
+                else:
+                    if occupancy.get((car.x, car.y)) is car: del occupancy[(car.x, car.y)]
+                    self._record_exit(car)
+            self.passed_cars += len(self._cars) - len(cars_on_grid)
+            self._cars = cars_on_grid
+
+        if self.arrival_rate is not None:
+            self.add_arrivals(self.arrivals.step())
+            for _ in self.approaches:
+                if not self._pending_total or len(self._cars) >= self.concurrent_cars: break
+                self.spawn_car()
+        elif len(self._cars) < self.concurrent_cars:
+            if self.rng.random() < 0.5: self.spawn_car()
+
+    def _move_cars(self):
+        occupancy = self._occupancy
+        lights = self.pattern.lights
+        intended_moves = {} # keyed by car: ids are only unique per intersection
+        for car in self._cars:
             car.stopped = False; car.color = Color.GREEN
-            light = self.pattern.lights[car.direction]
-            should_stop_for_light = (car.turn == "left" and light != Light.GREEN_ARROW) or \
-                                    (car.turn is None and light not in [Light.GREEN, Light.GREEN_ARROW])
-            at_intersection = (car.direction == "north" and car.y == INTERSECTION_END_Y + 1) or \
-                              (car.direction == "south" and car.y == INTERSECTION_START_Y - 1) or \
-                              (car.direction == "east" and car.x == INTERSECTION_START_X - 1) or \
-                              (car.direction == "west" and car.x == INTERSECTION_END_X + 1)
-            next_x, next_y, buffer_x, buffer_y = car.x, car.y, car.x, car.y
-            if car.direction == "north": next_y -= 1; buffer_y -= 2
-            elif car.direction == "south": next_y += 1; buffer_y += 2
-            elif car.direction == "east": next_x += 1; buffer_y += 2
-            elif car.direction == "west": next_x -= 1; buffer_y -= 2
-            is_car_ahead = self.get_car_at(next_x, next_y) or self.get_car_at(buffer_x, buffer_y)
-            if is_car_ahead or (at_intersection and should_stop_for_light):
-                intended_moves[car.id] = (car.x, car.y)
+            route, pos = car.route, car.pos
+            ahead = route.cells[pos + 1]
+            if ahead in occupancy or route.buffers[pos] in occupancy or (pos == route.stop and lights[route.approach] in route.halts):
+                intended_moves[car] = (car.x, car.y)
             else:
-                intended_moves[car.id] = (next_x, next_y)
+                intended_moves[car] = ahead
 
-        final_positions = {}; occupied_next_spots = set()
-        for car in self.cars:
-            intended_pos = intended_moves[car.id]
-            if intended_pos == (car.x, car.y):
-                final_positions[car.id] = (car.x, car.y); car.stopped = True; car.color = Color.RED
-                continue
-            if intended_pos in occupied_next_spots:
-                self.crashes += 1
-                self.crash_detected = True
-                final_positions[car.id] = (car.x, car.y); car.stopped = True; car.color = Color.RED
-            else:
-                final_positions[car.id] = intended_pos; occupied_next_spots.add(intended_pos)
+        entering = self._resolve_moves(intended_moves)
+        moved = [car for car in self._cars if entering.get(intended_moves[car]) is car]
+        for car in moved:
+            if occupancy.get((car.x, car.y)) is car: del occupancy[(car.x, car.y)]
+        for car in moved:
+            old_cell = (car.x, car.y)
+            car.move()
+            occupancy[(car.x, car.y)] = car
+            self._moved(old_cell, (car.x, car.y))
 
-        for car in self.cars:
-            car.x, car.y = final_positions[car.id]
-            if (car.x, car.y) != intended_moves[car.id]:
+        queued = self.queued
+        for car in self._cars:
+            if (car.x, car.y) != intended_moves[car]:
                  car.stopped = True; car.color = Color.RED
-            if car.turn == "left":
-                turned = False
-                if car.direction == "north" and car.y == LANE_E_Y: car.direction = "west"; turned = True
-                elif car.direction == "south" and car.y == LANE_W_Y: car.direction = "east"; turned = True
-                elif car.direction == "east" and car.x == LANE_N_X: car.direction = "north"; turned = True
-                elif car.direction == "west" and car.x == LANE_S_X: car.direction = "south"; turned = True
-                if turned: car.turn = None
-
-        cars_on_grid = [c for c in self.cars if 0 <= c.x < GRID_WIDTH and 0 <= c.y < GRID_HEIGHT]
-        self.passed_cars += len(self.cars) - len(cars_on_grid)
-        self.cars = cars_on_grid
-        
-        if len(self.cars) < self.concurrent_cars:
-            if random.random() < 0.5: self.spawn_car()
+            if car.stopped: car.wait += 1; queued[car.origin] += 1
+
+    def _resolve_moves(self, intended_moves):
+        # Which cars may make their intended moves (car -> cell; its own cell to stay),
+        # as target -> car, the same whatever the order of self._cars:
+        # 1. Of cars heading for one cell, the one with right of way gets it.
+        # 2. A car entering a cell that another leaves other than straight on (a swap or a
+        #    crossing, see Geometry.conflicts) stays put.
+        # 3. A car entering the cell of a car held back by 1 or 2 stays put too, and so on
+        #    back along the queue, so no cell ever takes two cars.
+        # Every car held back counts as a crash. The movement rules only let cars into
+        # cells that are free at the start of a step, so only 1 happens in a simulation;
+        # 2 and 3 keep the outcome safe for any intended moves.
+        entering = {}
+        held = []
+        for car in self._cars:
+            target = intended_moves[car]
+            if target == (car.x, car.y):
+                car.stopped = True; car.color = Color.RED
+                continue
+            other = entering.get(target)
+            if other is None: entering[target] = car; continue
+            if right_of_way(car) < right_of_way(other): entering[target] = car; car = other
+            held.append(car)
+        if len(entering) > 1:
+            conflicts = self.geometry.conflicts
+            leaving = {(car.x, car.y): car for car in entering.values()}
+            crossing = [car for target, car in entering.items() if target in leaving and
+                        (target, intended_moves[leaving[target]]) in conflicts.get(((car.x, car.y), target), ())]
+            for car in crossing: del entering[intended_moves[car]]
+            held += crossing
+        crashes = len(held)
+        while held:
+            car = held.pop()
+            follower = entering.pop((car.x, car.y), None)
+            if follower is not None: held.append(follower); crashes += 1
+        if crashes:
+            self.crashes += crashes; self.crash_detected = True
+        return entering
+
+    def _record_exit(self, car):
+        stats = self.wait_stats[car.origin]
+        stats[0] += 1; stats[1] += car.wait; stats[2] = max(stats[2], car.wait)
+        if self.metrics is not None: self.metrics.record_exit(car, self.steps)
+        if self.exits is not None: self.exits.append(car)
 
     def cycle(self): self.pattern.cycle()
 
+def right_of_way(car):
+    # Sort key for conflicting cars: the one that has been on the grid longest goes
+    # first, then the lowest id, then the topmost and leftmost cell.
+    return car.entered, car.id, car.y, car.x
+
+PATTERNS = {'simple': SimpleIntersection, 'protected-left': ProtectedLeftTurn, 'actuated': ActuatedIntersection}
+
+# Pacers sit between Intersection.run() and a renderer: each takes the stream of
+# snapshots and returns the ones to show, sleeping as needed.
+def unpaced(frames):
+    return frames
+
+class FastForward:
+    # Shows every nth step and never sleeps.
+    def __init__(self, every):
+        self.every = max(1, every)
+
+    def __call__(self, frames):
+        for i, frame in enumerate(frames, 1):
+            if i % self.every == 0: yield frame
+
+class RealTime:
+    # Shows one step every 1/fps seconds. When the consumer falls more than a frame
+    # behind, steps are still simulated but not shown until it has caught up.
+    def __init__(self, fps, skip_frames=True):
+        self.interval = 1.0 / fps
+        self.skip_frames = skip_frames
+
+    def __call__(self, frames):
+        due = time.perf_counter()
+        for frame in frames:
+            now = time.perf_counter()
+            if self.skip_frames and now > due + self.interval:
+                due += self.interval
+                continue
+            if now < due: time.sleep(due - now)
+            due += self.interval
+            yield frame
+
+# Binary traces: a header followed by one fixed-size record per snapshot, so step i is
+# at a known offset. A record is a step header, then `capacity` car slots of which the
+# first n_cars are used.
+# goal_cars is None for runs without a goal (see run_long); it is stored as 0 with the
+# unlimited flag set.
+TRACE_MAGIC = b"TRAFTRC3"
+TRACE_HEADER = struct.Struct("<8sIQ?IH?24s?") # magic, capacity, goal_cars, unlimited, approach length, lanes, heading look-ahead, pattern, protected
+TRACE_STEP = struct.Struct("<IIIII4B?") # step, cars_created, passed_cars, crashes, n_cars, lights, cleanup
+TRACE_CAR = struct.Struct("<IiiB") # id, x, y, direction index | stopped << 2
+TRACE_LIGHTS = list(Light)
+
+class TraceWriter:
+    # Records snapshots to a binary trace. Use write() directly, or wrap a snapshot
+    # stream like a pacer to record while it is consumed:
+    #   for frame in RealTime(4)(TraceWriter(f, 15)(intersection.run())): ...
+    def __init__(self, stream, capacity):
+        self.stream = stream
+        self.capacity = capacity
+        self.record_size = TRACE_STEP.size + capacity * TRACE_CAR.size
+        self.records = 0
+
+    def write(self, frame):
+        if len(frame.cars) > self.capacity:
+            raise ValueError(f"{len(frame.cars)} cars in step {frame.step} exceeds trace capacity {self.capacity}")
+        if self.records == 0:
+            geometry = frame.geometry or DEFAULT_GEOMETRY
+            unlimited = frame.goal_cars is None
+            self.stream.write(TRACE_HEADER.pack(TRACE_MAGIC, self.capacity, 0 if unlimited else frame.goal_cars, unlimited,
+                                                geometry.approach_length, geometry.lanes, geometry.heading_look_ahead, frame.pattern.encode()[:24], frame.protected))
+        record = bytearray(self.record_size)
+        TRACE_STEP.pack_into(record, 0, frame.step, frame.cars_created, frame.passed_cars, frame.crashes, len(frame.cars),
+                             *(TRACE_LIGHTS.index(frame.lights[d]) for d in DIRECTIONS), frame.cleanup)
+        offset = TRACE_STEP.size
+        for car_id, x, y, direction, stopped in frame.cars:
+            TRACE_CAR.pack_into(record, offset, car_id, x, y, DIRECTIONS.index(direction) | stopped << 2)
+            offset += TRACE_CAR.size
+        self.stream.write(record)
+        self.records += 1
+
+    def __call__(self, frames):
+        for frame in frames:
+            self.write(frame)
+            yield frame
+
+class TraceReader:
+    # Random access to a recorded trace: reader[i] is the i-th snapshot, decoded from
+    # a memory map of the file on demand, so any step is available without replaying.
+    def __init__(self, path):
+        import mmap
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < TRACE_HEADER.size: raise ValueError(f"{path} is not a traffic trace")
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.capacity, self.goal_cars, unlimited, approach_length, lanes, heading, pattern, self.protected = TRACE_HEADER.unpack_from(self._map)
+        if magic != TRACE_MAGIC: raise ValueError(f"{path} is not a traffic trace")
+        if unlimited: self.goal_cars = None
+        self.geometry = Geometry(approach_length, lanes, heading)
+        if self.geometry == DEFAULT_GEOMETRY: self.geometry = None
+        self.pattern = pattern.rstrip(b"\0").decode()
+        self.record_size = TRACE_STEP.size + self.capacity * TRACE_CAR.size
+        self._records = (len(self._map) - TRACE_HEADER.size) // self.record_size
+
+    def __len__(self):
+        return self._records
+
+    def record(self, i):
+        # The raw bytes of record i, e.g. for comparing traces without decoding them.
+        if i < 0: i += self._records
+        if not 0 <= i < self._records: raise IndexError("trace index out of range")
+        start = TRACE_HEADER.size + i * self.record_size
+        return self._map[start:start + self.record_size]
+
+    def __getitem__(self, i):
+        record = self.record(i)
+        step, created, passed, crashes, n_cars, *lights, cleanup = TRACE_STEP.unpack_from(record)
+        cars = []
+        for car_id, x, y, code in TRACE_CAR.iter_unpack(record[TRACE_STEP.size:TRACE_STEP.size + n_cars * TRACE_CAR.size]):
+            cars.append((car_id, x, y, DIRECTIONS[code & 3], bool(code & 4)))
+        return Snapshot(step, tuple(cars), {d: TRACE_LIGHTS[light] for d, light in zip(DIRECTIONS, lights)},
+                        created, passed, self.goal_cars, crashes, self.pattern, self.protected, cleanup, self.geometry)
+
+    def __iter__(self):
+        return (self[i] for i in range(self._records))
+
+    def find_step(self, step):
+        # Index of the first record at or after the given step (steps only increase).
+        lo, hi = 0, self._records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if TRACE_STEP.unpack_from(self.record(mid))[0] < step: lo = mid + 1
+            else: hi = mid
+        return lo
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def first_difference(a, b):
+    # Index of the first snapshot where two traces differ, or None if they are identical.
+    # Traces recorded with different capacities compare equal if their snapshots do.
+    for i in range(min(len(a), len(b))):
+        if a[i] != b[i]: return i
+    return None if len(a) == len(b) else min(len(a), len(b))
+
+def run_simulation(seed, pattern='simple', cars=20, turn_ratio=0.2, distribution=1.0, ignore_crashes=False, concurrent_cars=15, engine='python', plan=None, arrival_rate=None, metrics=False, geometry=None, max_steps=MAX_STEPS):
+    # Headless equivalent of the __main__ loop: no rendering, no sleeping.
+    intersection = Intersection(min(concurrent_cars, cars), cars, PATTERNS[pattern], is_test_mode=True, seed=seed,
+                                left_turn_percentage=turn_ratio,
+                                distribution_factor=distribution,
+                                ignore_crashes=ignore_crashes,
+                                engine=engine, timing_plan=plan, arrival_rate=arrival_rate,
+                                metrics=Metrics() if metrics else None, geometry=geometry, max_steps=max_steps)
+    for _ in range(intersection.concurrent_cars):
+        intersection.spawn_car()
+    for _ in intersection.run(snapshots=False): pass
+    result = {
+        "seed": seed,
+        "steps": intersection.steps,
+        "cleanup_steps": intersection.cleanup_steps,
+        "cars_created": intersection.cars_created,
+        "passed_cars": intersection.passed_cars,
+        "goal_cars": intersection.goal_cars,
+        "crashes": intersection.crashes,
+        "waits": {d: tuple(stats) for d, stats in intersection.wait_stats.items()},
+    }
+    if metrics: result["metrics"] = intersection.metrics.summary()
+    return result
+
+def run_long(seed, steps=None, warmup=1000, precision=None, report_every=10000, confidence=0.95, stall_steps=1000, pattern='simple', turn_ratio=0.2, distribution=1.0, ignore_crashes=False, concurrent_cars=15, engine='python', plan=None, arrival_rate=None, geometry=None):
+    # Steady-state study of one intersection with unlimited cars. Steps until `steps`
+    # steps (None: no limit), a crash (unless ignored), gridlock (no car has moved for
+    # `stall_steps` steps), or, with `precision`, until the confidence intervals on
+    # throughput and mean wait are within that fraction of their estimates. Yields a
+    # SteadyState report every `report_every` steps and at the end; memory stays fixed
+    # however long it runs. A report's "valid" is False once the run has stopped on
+    # gridlock or a crash: its estimates are then not of a steady state.
+    stats = SteadyState(warmup)
+    intersection = Intersection(concurrent_cars, None, PATTERNS[pattern], is_test_mode=True, seed=seed,
+                                left_turn_percentage=turn_ratio, distribution_factor=distribution,
+                                ignore_crashes=ignore_crashes, engine=engine, timing_plan=plan,
+                                arrival_rate=arrival_rate, metrics=stats, geometry=geometry, max_steps=steps)
+    for _ in range(intersection.concurrent_cars):
+        intersection.spawn_car()
+    step = intersection.pattern.step
+    def report():
+        gridlock = stats.stalled >= stall_steps
+        crashed = intersection.crashes > 0 and not ignore_crashes
+        return dict(stats.report(confidence), step=intersection.steps, crashes=intersection.crashes,
+                    on_grid=intersection.on_grid, gridlock=gridlock, valid=not (gridlock or crashed))
+    while not intersection.is_finished() and stats.stalled < stall_steps:
+        step()
+        if intersection.steps % report_every == 0:
+            yield report()
+            if precision is not None and stats.converged(precision, confidence): return
+    if intersection.steps % report_every: yield report()
+
+def run_batch(runs, workers=None, seed=0, chunksize=None, **sim_kwargs):
+    # Yields results as they complete (unordered) so callers can aggregate in bounded memory.
+    job = functools.partial(run_simulation, **sim_kwargs)
+    seeds = range(seed, seed + runs)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        yield from map(job, seeds)
+        return
+    import multiprocessing # deferred: it is the bulk of import time for worker processes
+    chunksize = chunksize or max(1, min(64, runs // (workers * 8)))
+    with multiprocessing.Pool(workers, initializer=set_color_mode, initargs=(False,)) as pool:
+        yield from pool.imap_unordered(job, seeds, chunksize=chunksize)
+
+class BatchSummary:
+    def __init__(self):
+        self.runs = 0
+        self.crashed_runs = 0
+        self.finished_runs = 0
+        self.total_steps = 0
+        self.total_passed = 0
+        self.finish_steps_sum = 0
+        self.finish_steps_sq_sum = 0
+        self.finish_steps_min = None
+        self.finish_steps_max = None
+        self.waits = {d: [0, 0, 0] for d in DIRECTIONS}
+        self.travel = [0, 0.0, 0] # from runs with metrics: cars, total, max
+
+    def add(self, result):
+        # Cars finishing during cleanup count as passed, so cleanup steps count too.
+        steps = result["steps"] + result["cleanup_steps"]
+        self.runs += 1
+        self.total_steps += steps
+        self.total_passed += result["passed_cars"]
+        if result["crashes"] > 0: self.crashed_runs += 1
+        if result["passed_cars"] >= result["goal_cars"]:
+            self.finished_runs += 1
+            self.finish_steps_sum += steps; self.finish_steps_sq_sum += steps * steps
+            self.finish_steps_min = steps if self.finish_steps_min is None else min(self.finish_steps_min, steps)
+            self.finish_steps_max = steps if self.finish_steps_max is None else max(self.finish_steps_max, steps)
+        for d, (count, total, longest) in result["waits"].items():
+            stats = self.waits[d]
+            stats[0] += count; stats[1] += total; stats[2] = max(stats[2], longest)
+        if "metrics" in result:
+            travel = result["metrics"]["travel"]
+            self.travel[0] += travel["cars"]; self.travel[1] += travel["mean"] * travel["cars"]
+            self.travel[2] = max(self.travel[2], travel["max"])
+
+    def report(self):
+        n = self.finished_runs
+        mean = self.finish_steps_sum / n if n else None
+        std = max(0.0, self.finish_steps_sq_sum / n - mean * mean) ** 0.5 if n else None
+        return {
+            "runs": self.runs,
+            "throughput": self.total_passed / self.total_steps if self.total_steps else 0.0,
+            "crash_rate": self.crashed_runs / self.runs if self.runs else 0.0,
+            "finish_rate": n / self.runs if self.runs else 0.0,
+            "steps_to_finish": {"mean": mean, "std": std, "min": self.finish_steps_min, "max": self.finish_steps_max},
+            "wait": {d: {"cars": count, "mean": total / count if count else 0.0, "max": longest}
+                     for d, (count, total, longest) in self.waits.items()},
+            "travel": {"cars": self.travel[0], "mean": self.travel[1] / self.travel[0] if self.travel[0] else 0.0, "max": self.travel[2]},
+        }
+
+class EvaluationCache:
+    # Simulation results on disk, keyed by (plan, seed, demand), so an optimizer run that
+    # is repeated or resumed never re-simulates a configuration. The file is JSON lines,
+    # appended to as results come in; a partly written last line is ignored.
+    def __init__(self, path=None):
+        import json
+        self._json = json
+        self.path = path
+        self.results = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try: entry = json.loads(line)
+                    except ValueError: continue
+                    self.results[entry["key"]] = entry["result"]
+        self._file = open(path, 'a') if path else None
+
+    VERSION = 4 # raised when results record something new, so older entries are not reused
+
+    def key(self, plan, seed, demand):
+        data = plan.to_dict()
+        data.pop("name")
+        return self._json.dumps([self.VERSION, data, seed, demand], sort_keys=True, separators=(",", ":"), default=repr)
+
+    def get(self, key):
+        return self.results.get(key)
+
+    def put(self, key, result):
+        self.results[key] = result
+        if self._file:
+            self._file.write(self._json.dumps({"key": key, "result": result}) + "\n")
+            self._file.flush()
+
+    def close(self):
+        if self._file: self._file.close()
+
+def _evaluate(job):
+    key, plan, seed, demand = job
+    result = run_simulation(seed, plan=plan, **demand)
+    waits = result["waits"].values()
+    return key, {"steps": result["steps"] + result["cleanup_steps"], "passed_cars": result["passed_cars"], "crashes": result["crashes"],
+                 "wait_cars": sum(w[0] for w in waits), "wait_total": sum(w[1] for w in waits),
+                 "unfinished": max(0, result["goal_cars"] - result["passed_cars"])}
+
+OBJECTIVES = {
+    # Higher is better. Plans with crashes in any run are rejected outright. Mean wait is
+    # over every car the run asked for: a car that did not finish (still on the grid, or
+    # never let on) is charged the whole run, so a plan cannot score well by leaving
+    # its slowest cars out of the average.
+    "throughput": lambda results: sum(r["passed_cars"] / r["steps"] for r in results if r["steps"]) / len(results),
+    "wait": lambda results: -sum(r["wait_total"] + r["unfinished"] * r["steps"] for r in results)
+                            / max(1, sum(r["wait_cars"] + r["unfinished"] for r in results)),
+}
+
+class PlanOptimizer:
+    # Searches phase durations of a timing plan by pattern search: each round scores
+    # every plan one `step` longer or shorter in a single phase, moves to the best one,
+    # and halves the step when nothing improves. A plan's score is the objective over
+    # the same seeds for every candidate. Simulations run in a worker pool and go
+    # through the cache, so only configurations never seen before are simulated.
+    # Yellow and all-red phases have their own floor, `min_clearance`, and on multi-lane
+    # layouts together must still leave the clearance (see Geometry.required_clearance).
+    def __init__(self, plan, seeds, demand, objective='throughput', cache=None, workers=None,
+                 min_duration=1, max_duration=30, min_clearance=2):
+        if objective not in OBJECTIVES:
+            raise ValueError(f"Unknown objective {objective!r}; choose from {', '.join(OBJECTIVES)}.")
+        self.plan = plan
+        self.seeds = list(seeds)
+        self.demand = dict(demand)
+        self.objective = OBJECTIVES[objective]
+        self.cache = cache or EvaluationCache()
+        self.workers = workers or os.cpu_count() or 1
+        self.min_duration, self.max_duration = min_duration, max_duration
+        self.min_clearance = min_clearance
+        self.clearance = self.demand.get("geometry", DEFAULT_GEOMETRY).required_clearance or 0
+        self._clearance_phases = {i for i, (lights, _) in enumerate(plan.phases)
+                                  if not any(light in (Light.GREEN, Light.GREEN_ARROW) for light in lights.values())}
+        self.simulated = 0
+        self._pool = None
+
+    def score(self, plans):
+        # Scores for a list of plans (None for a plan that crashed), simulating only
+        # the (plan, seed) pairs that are not cached yet.
+        keys = [[self.cache.key(plan, seed, self.demand) for seed in self.seeds] for plan in plans]
+        jobs = {}
+        for plan, plan_keys in zip(plans, keys):
+            for key, seed in zip(plan_keys, self.seeds):
+                if self.cache.get(key) is None and key not in jobs: jobs[key] = (key, plan, seed, self.demand)
+        if self.workers == 1 or len(jobs) < 2:
+            done = map(_evaluate, jobs.values())
+        else:
+            if self._pool is None:
+                import multiprocessing
+                self._pool = multiprocessing.Pool(self.workers, initializer=set_color_mode, initargs=(False,))
+            done = self._pool.imap_unordered(_evaluate, jobs.values(), chunksize=max(1, len(jobs) // (self.workers * 4)))
+        for key, result in done:
+            self.cache.put(key, result)
+        self.simulated += len(jobs)
+        scores = []
+        for plan_keys in keys:
+            results = [self.cache.get(key) for key in plan_keys]
+            scores.append(None if any(r["crashes"] for r in results) else self.objective(results))
+        return scores
+
+    def neighbours(self, durations, step):
+        for i in range(len(durations)):
+            shortest = self.min_clearance if i in self._clearance_phases else self.min_duration
+            for delta in (-step, step):
+                duration = durations[i] + delta
+                if shortest <= duration <= self.max_duration:
+                    candidate = durations[:i] + (duration,) + durations[i + 1:]
+                    # Plans too short on yellow and all-red for the layout are not tried.
+                    clearance = self.plan.with_durations(candidate).clearance()
+                    if clearance is None or clearance >= self.clearance: yield candidate
+
+    def run(self, step=4, max_rounds=50, progress=None):
+        # Returns the best plan found and its score. progress(round, plan, score) is
+        # called after every round.
+        best = tuple(duration for _, duration in self.plan.phases)
+        best_score = self.score([self.plan])[0]
+        try:
+            for round_number in range(1, max_rounds + 1):
+                if step < 1: break
+                candidates = list(self.neighbours(best, step))
+                scores = self.score([self.plan.with_durations(c) for c in candidates])
+                improved = [(score, c) for score, c in zip(scores, candidates)
+                            if score is not None and (best_score is None or score > best_score)]
+                if improved:
+                    best_score, best = max(improved)
+                else:
+                    step //= 2
+                if progress: progress(round_number, self.plan.with_durations(best), best_score)
+        finally:
+            self.close()
+        return self.plan.with_durations(best), best_score
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close(); self._pool.join()
+            self._pool = None
+
+# (row, column) offset of the next intersection for a car leaving in each direction.
+NEIGHBOUR_OFFSETS = {"north": (-1, 0), "south": (1, 0), "east": (0, 1), "west": (0, -1)}
+
+class NetworkRegion:
+    # A group of intersections from a RoadNetwork that are stepped together. Cars moving
+    # between two of its own intersections are handed over locally; cars bound for an
+    # intersection in another region are returned from step() for the network to deliver.
+    # Each intersection's RNG is seeded from the network seed and its position, and
+    # handovers are admitted in a fixed order, so results do not depend on the regions.
+    # An intersection holding cars none of which has moved, entered or left for
+    # `stall_ticks` ticks is reported as stalled.
+    def __init__(self, rows, cols, keys, seed=0, pattern='simple', cars=20, concurrent_cars=15, turn_ratio=0.2, distribution=1.0, ignore_crashes=False, engine='python', plan=None, arrival_rate=None, geometry=None, stall_ticks=200):
+        self.rows, self.cols = rows, cols
+        self.nodes = {}
+        self.pending = {} # cars waiting for their entry cell to clear
+        self.idle = {} # consecutive ticks each intersection held cars and none of them moved
+        self.stall_ticks = stall_ticks
+        self.exited = 0
+        self.handovers = 0
+        self._local = [] # handovers between this region's own intersections, admitted next tick
+        for key in keys:
+            # Only approaches fed from outside the network get new cars.
+            approaches = [d for d in DIRECTIONS if not self.in_network(key, -1, d)]
+            node = Intersection(concurrent_cars, cars if approaches else 0, PATTERNS[pattern], is_test_mode=True,
+                                left_turn_percentage=turn_ratio, distribution_factor=distribution,
+                                ignore_crashes=ignore_crashes, engine=engine, approaches=approaches, timing_plan=plan,
+                                arrival_rate=arrival_rate, seed=f"{seed}:{key[0]},{key[1]}", geometry=geometry)
+            node.exits = []
+            self.nodes[key] = node
+            self.pending[key] = collections.deque()
+            self.idle[key] = 0
+
+    def in_network(self, key, sign, direction):
+        dr, dc = NEIGHBOUR_OFFSETS[direction]
+        return 0 <= key[0] + sign * dr < self.rows and 0 <= key[1] + sign * dc < self.cols
+
+    def arrive(self, key, direction, car_id):
+        node = self.nodes[key]
+        self.pending[key].append(Car(car_id, direction, node.choose_turn(), geometry=node.geometry))
+
+    def step(self, inbound=()):
+        arrivals, self._local = sorted(itertools.chain(inbound, self._local)), []
+        for key, direction, car_id in arrivals:
+            self.arrive(key, direction, car_id)
+        for key, node in self.nodes.items():
+            queue = self.pending[key]
+            waiting = len(queue)
+            for _ in range(waiting):
+                car = queue.popleft()
+                if not node.admit_car(car): queue.append(car)
+            node.pattern.step()
+            moved = len(queue) < waiting or node.exits or sum(node.queued.values()) < node.on_grid
+            self.idle[key] = 0 if moved or not (node.on_grid or queue) else self.idle[key] + 1
+        outbound = []
+        for key, node in self.nodes.items():
+            for car in node.exits:
+                if not self.in_network(key, 1, car.direction):
+                    self.exited += 1
+                    continue
+                self.handovers += 1
+                dr, dc = NEIGHBOUR_OFFSETS[car.direction]
+                target = (key[0] + dr, key[1] + dc)
+                (self._local if target in self.nodes else outbound).append((target, car.direction, car.id))
+            node.exits.clear()
+        return outbound
+
+    def stats(self):
+        waits = {d: [0, 0, 0] for d in DIRECTIONS}
+        for node in self.nodes.values():
+            for d, (count, total, longest) in node.wait_stats.items():
+                waits[d][0] += count; waits[d][1] += total; waits[d][2] = max(waits[d][2], longest)
+        return {
+            "created": sum(node.cars_created for node in self.nodes.values()),
+            "exited": self.exited,
+            "handovers": self.handovers,
+            "crashes": sum(node.crashes for node in self.nodes.values()),
+            "on_network": sum(node.on_grid for node in self.nodes.values()) + sum(len(q) for q in self.pending.values()) + len(self._local),
+            "waits": waits,
+            # (row, col, cars on it, cars waiting to enter) for every stalled intersection.
+            "stalled": [(*key, node.on_grid, len(self.pending[key])) for key, node in self.nodes.items() if self.idle[key] >= self.stall_ticks],
+            "pending_max": max((len(q) for q in self.pending.values()), default=0),
+        }
+
+def _region_worker(conn, seed, args, kwargs):
+    set_color_mode(False)
+    region = NetworkRegion(*args, seed=seed, **kwargs)
+    try:
+        while True:
+            message = conn.recv()
+            if message is None: break
+            command, inbound = message
+            conn.send(region.step(inbound) if command == "step" else region.stats())
+    finally:
+        conn.close()
+
+class RoadNetwork:
+    # A rows x cols grid of intersections, each with its own traffic pattern. A car that
+    # leaves one intersection's edge enters the neighbouring intersection's approach lane.
+    # With workers > 1 the grid is split into bands of rows, each stepped in its own
+    # process, and only cars crossing a band boundary are exchanged each tick. Every
+    # handover, local or not, is admitted at the start of the next tick.
+    def __init__(self, rows, cols, workers=1, seed=0, **region_kwargs):
+        self.rows, self.cols = rows, cols
+        self.ticks = 0
+        self.stall_ticks = region_kwargs.get("stall_ticks", 200)
+        bands = min(max(1, workers), rows)
+        keys = [[(r, c) for r in range(rows * i // bands, rows * (i + 1) // bands) for c in range(cols)] for i in range(bands)]
+        self.owner = {key: i for i, band in enumerate(keys) for key in band}
+        self._inbound = [[] for _ in keys]
+        self._conns = []
+        self._processes = []
+        if bands == 1:
+            self.regions = [NetworkRegion(rows, cols, keys[0], seed, **region_kwargs)]
+            return
+        import multiprocessing
+        self.regions = None
+        for i, band in enumerate(keys):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_region_worker, args=(child, seed, (rows, cols, band), region_kwargs), daemon=True)
+            process.start()
+            child.close()
+            self._conns.append(parent)
+            self._processes.append(process)
+
+    def step(self):
+        inbound, self._inbound = self._inbound, [[] for _ in self._inbound]
+        if self.regions is not None:
+            outbound = [region.step(batch) for region, batch in zip(self.regions, inbound)]
+        else:
+            for conn, batch in zip(self._conns, inbound): conn.send(("step", batch))
+            outbound = [conn.recv() for conn in self._conns]
+        for cars in outbound:
+            for item in cars: self._inbound[self.owner[item[0]]].append(item)
+        self.ticks += 1
+
+    def run(self, ticks):
+        # Steps `ticks` ticks, or fewer if an intersection stalls: the returned stats then
+        # list it under "stalled", and the run should not be taken as a result.
+        for tick in range(1, ticks + 1):
+            self.step()
+            if tick % self.stall_ticks == 0 and self.stats()["stalled"]: break
+        return self.stats()
+
+    def stats(self):
+        if self.regions is not None:
+            parts = [region.stats() for region in self.regions]
+        else:
+            for conn in self._conns: conn.send(("stats", None))
+            parts = [conn.recv() for conn in self._conns]
+        totals = {"ticks": self.ticks, "created": 0, "exited": 0, "handovers": 0, "crashes": 0, "on_network": 0,
+                  "stalled": [], "pending_max": 0}
+        waits = {d: [0, 0, 0] for d in DIRECTIONS}
+        for part in parts:
+            for name in ("created", "exited", "handovers", "crashes", "on_network"): totals[name] += part[name]
+            totals["stalled"] += part["stalled"]
+            totals["pending_max"] = max(totals["pending_max"], part["pending_max"])
+            for d, (count, total, longest) in part["waits"].items():
+                waits[d][0] += count; waits[d][1] += total; waits[d][2] = max(waits[d][2], longest)
+        totals["on_network"] += sum(len(batch) for batch in self._inbound)
+        totals["waits"] = waits
+        return totals
+
+    def close(self):
+        for conn in self._conns:
+            conn.send(None); conn.close()
+        for process in self._processes: process.join()
+        self._conns, self._processes = [], []
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Traffic Simulation")
-    parser.add_argument('--pattern', '-p', type=str, default='simple', choices=['simple', 'protected-left'], help='Traffic pattern to simulate.')
+    parser.add_argument('mode', nargs='?', default='run', choices=['run', 'batch', 'network', 'replay', 'optimize', 'long'], help='Animate a single run, run many headless simulations in parallel, simulate a grid of intersections, replay a recorded trace, search for better signal timings, or run one intersection for a steady-state study.')
+    parser.add_argument('--pattern', '-p', type=str, default='simple', choices=list(PATTERNS), help='Traffic pattern to simulate.')
     parser.add_argument('--cars', '-c', type=int, default=20, help='Total number of cars to simulate.')
     parser.add_argument('--turn-ratio', '-t', type=float, default=0.2, help='Ratio of cars that will turn left (0.0 to 1.0). Only for protected-left pattern.')
     parser.add_argument('--distribution', '-d', type=float, default=1.0, help='Distribution of cars across directions (0.0=random, 1.0=even).')
+    parser.add_argument('--arrival-rate', type=float, default=None, help='Poisson arrivals per step over all approaches (default: a car whenever there is room).')
+    parser.add_argument('--concurrent-cars', type=int, default=15, help='Maximum number of cars on the grid at once.')
+    parser.add_argument('--approach-length', type=int, default=INTERSECTION_START_X, help='Cells of road before the intersection on each side.')
+    parser.add_argument('--lanes', type=int, default=1, help='Lanes in each direction.')
+    parser.add_argument('--look-ahead', type=str, default='heading', choices=['heading', 'sideways'], help='Cell a car checks before moving: two along its heading, or the original rule (eastbound and westbound cars look two cells sideways), which locks up under sustained demand.')
     parser.add_argument('--ignore-crashes', action='store_true', help='Continue simulation even after a crash.')
+    parser.add_argument('--fps', type=float, default=4, help='Steps shown per second; 0 runs as fast as possible.')
+    parser.add_argument('--no-color', action='store_true', help='Disable terminal colors.')
+    parser.add_argument('--engine', type=str, default='python', choices=list(ENGINES), help='Stepping engine (numpy requires numpy).')
+    parser.add_argument('--runs', '-n', type=int, default=None, help='Number of simulations to run in batch mode (default: 1000), or seeds to score each candidate on in optimize mode (default: 50).')
+    parser.add_argument('--workers', '-w', type=int, default=None, help='Worker processes (default: all cores; 1 in network mode).')
+    parser.add_argument('--seed', '-s', type=int, default=0, help='First seed for batch mode; run i uses seed + i.')
+    parser.add_argument('--plan', type=str, default=None, help='JSON file of signal timing plans (batch mode runs each one).')
+    parser.add_argument('--rows', type=int, default=3, help='Rows of intersections in network mode.')
+    parser.add_argument('--cols', type=int, default=3, help='Columns of intersections in network mode.')
+    parser.add_argument('--ticks', type=int, default=1000, help='Steps to simulate in network mode.')
+    parser.add_argument('--metrics', type=str, default=None, help='Stream metrics to this file (CSV if it ends in .csv, otherwise JSONL).')
+    parser.add_argument('--record', type=str, default=None, help='Record the run to this binary trace file.')
+    parser.add_argument('--trace', type=str, default=None, help='Trace file to replay in replay mode.')
+    parser.add_argument('--start', type=int, default=0, help='Step to start a replay from.')
+    parser.add_argument('--objective', type=str, default='throughput', choices=list(OBJECTIVES), help='What optimize mode maximizes: cars finished per step, or (minus) mean wait.')
+    parser.add_argument('--cache', type=str, default='optimize_cache.jsonl', help='File caching simulation results in optimize mode.')
+    parser.add_argument('--min-duration', type=int, default=1, help='Shortest phase optimize mode may try, in steps.')
+    parser.add_argument('--max-duration', type=int, default=30, help='Longest phase optimize mode may try, in steps.')
+    parser.add_argument('--min-clearance', type=int, default=2, help='Shortest yellow or all-red phase optimize mode may try, in steps.')
+    parser.add_argument('--output', '-o', type=str, default=None, help='Write the optimized plan to this JSON file.')
+    parser.add_argument('--prometheus', type=str, default=None, help='Write a Prometheus text dump of the metrics to this file at the end of a run.')
+    parser.add_argument('--max-steps', type=int, default=None, help=f'Step limit per simulation; 0 for none (default: {MAX_STEPS}, or none in long mode).')
+    parser.add_argument('--warmup', type=int, default=1000, help='Steps long mode discards before collecting statistics.')
+    parser.add_argument('--precision', type=float, default=None, help='Stop long mode once the confidence intervals on throughput and mean wait are within this fraction of the estimates.')
+    parser.add_argument('--report-every', type=int, default=10000, help='Steps between long mode reports.')
     args = parser.parse_args()
 
     if not 0.0 <= args.turn_ratio <= 1.0: raise ValueError("Turn ratio must be between 0.0 and 1.0.")
     if not 0.0 <= args.distribution <= 1.0: raise ValueError("Distribution must be between 0.0 and 1.0.")
 
-    pattern_class = {'simple': SimpleIntersection, 'protected-left': ProtectedLeftTurn}[args.pattern]
-    concurrent_cars = 15
-    if args.cars < 15: concurrent_cars = args.cars
+    if args.no_color: set_color_mode(False)
+
+    plans = load_plans(args.plan) if args.plan else [None]
+    max_steps = MAX_STEPS if args.max_steps is None else args.max_steps or None
+    geometry = Geometry(args.approach_length, args.lanes, heading_look_ahead=args.look_ahead == 'heading')
+    if geometry == DEFAULT_GEOMETRY: geometry = None
+
+    if args.mode == 'batch':
+        # With a plan file, every plan in it is run against the same seeds. With --metrics,
+        # each run's metrics summary is written as one JSON line.
+        import json
+        metrics_file = open(args.metrics, 'w') if args.metrics else None
+        for plan in plans:
+            summary = BatchSummary()
+            stopped = False
+            try:
+                for result in run_batch(args.runs or 1000, workers=args.workers, seed=args.seed,
+                                        pattern=args.pattern, cars=args.cars,
+                                        turn_ratio=args.turn_ratio, distribution=args.distribution,
+                                        ignore_crashes=args.ignore_crashes,
+                                        concurrent_cars=args.concurrent_cars,
+                                        engine=args.engine, plan=plan, arrival_rate=args.arrival_rate,
+                                        metrics=metrics_file is not None, geometry=geometry, max_steps=max_steps):
+                    summary.add(result)
+                    if metrics_file:
+                        metrics_file.write(json.dumps({"seed": result["seed"], "plan": plan.name if plan else None, **result["metrics"]}) + "\n")
+            except KeyboardInterrupt:
+                print("\nBatch stopped.")
+                stopped = True
+            report = summary.report()
+            steps = report["steps_to_finish"]
+            print(f"Pattern: {args.pattern}  Runs: {report['runs']}")
+            if plan is not None: print(f"Plan: {plan!r}")
+            print(f"Throughput: {report['throughput']:.3f} cars/step")
+            print(f"Crash rate: {report['crash_rate']:.1%}")
+            print(f"Finish rate: {report['finish_rate']:.1%}")
+            if steps["mean"] is not None:
+                print(f"Steps to finish: mean {steps['mean']:.1f}, std {steps['std']:.1f}, min {steps['min']}, max {steps['max']}")
+            for d, wait in report["wait"].items():
+                print(f"Wait {d:>5}: mean {wait['mean']:.2f} steps, max {wait['max']} ({wait['cars']} cars)")
+            if report["travel"]["cars"]:
+                print(f"Travel time: mean {report['travel']['mean']:.2f} steps, max {report['travel']['max']}")
+            if stopped: break
+        if metrics_file: metrics_file.close()
+        raise SystemExit(0)
+
+    if args.mode == 'optimize':
+        import json
+        demand = {"pattern": args.pattern, "cars": args.cars, "turn_ratio": args.turn_ratio,
+                  "distribution": args.distribution, "concurrent_cars": args.concurrent_cars,
+                  "arrival_rate": args.arrival_rate, "ignore_crashes": args.ignore_crashes}
+        if geometry: demand["geometry"] = geometry
+        cache = EvaluationCache(args.cache)
+        start_plan = plans[0] or PATTERNS[args.pattern].PLAN.with_clearance((geometry or DEFAULT_GEOMETRY).clearance)
+        optimizer = PlanOptimizer(start_plan, range(args.seed, args.seed + (args.runs or 50)),
+                                  demand, objective=args.objective, cache=cache, workers=args.workers,
+                                  min_duration=args.min_duration, max_duration=args.max_duration, min_clearance=args.min_clearance)
+        def progress(round_number, plan, score):
+            score_text = "crashes" if score is None else f"{score:.4f}"
+            print(f"Round {round_number}: {plan!r} {args.objective} {score_text} ({optimizer.simulated} simulated, {len(cache.results)} cached)")
+        try:
+            plan, score = optimizer.run(progress=progress)
+        except KeyboardInterrupt:
+            print("\nOptimization stopped; finished simulations are cached, so rerunning resumes.")
+            raise SystemExit(1)
+        finally:
+            cache.close()
+        print(f"Best: {plan!r}")
+        if args.output:
+            with open(args.output, 'w') as f: json.dump(plan.to_dict(), f, indent=2)
+        raise SystemExit(0)
+
+    if args.mode == 'long':
+        # One report line every --report-every steps; with --metrics, each report is also
+        # written as one JSON line.
+        import json
+        metrics_file = open(args.metrics, 'w') if args.metrics else None
+        interval = lambda estimate, unit: f"{estimate['mean']:.4f}" + (f" ± {estimate['ci']:.4f}" if estimate['ci'] is not None else "") + unit
+        report = None
+        try:
+            for report in run_long(args.seed, steps=args.max_steps or None, warmup=args.warmup, precision=args.precision,
+                                   report_every=args.report_every, pattern=args.pattern, turn_ratio=args.turn_ratio,
+                                   distribution=args.distribution, ignore_crashes=args.ignore_crashes,
+                                   concurrent_cars=args.concurrent_cars, engine=args.engine, plan=plans[0],
+                                   arrival_rate=args.arrival_rate, geometry=geometry):
+                quantiles = ", ".join(f"{name} {value:.1f}" for name, value in report["wait"]["quantiles"].items() if value is not None)
+                print(f"Step {report['step']}: throughput {interval(report['throughput'], ' cars/step')}, "
+                      f"wait {interval(report['wait'], ' steps')}" + (f" ({quantiles})" if quantiles else ""))
+                if metrics_file: metrics_file.write(json.dumps(report) + "\n")
+        except KeyboardInterrupt:
+            print("\nLong run stopped.")
+        if metrics_file: metrics_file.close()
+        if report is not None:
+            print(f"Pattern: {args.pattern}  Steps: {report['step']} ({report['steps']} after a warm-up of {report['warmup']})")
+            if report["valid"]:
+                for d, estimate in report["throughput"]["approaches"].items():
+                    print(f"Throughput {d:>5}: {interval(estimate, ' cars/step')}")
+                if report["travel"]["cars"]:
+                    print(f"Travel time: mean {report['travel']['mean']:.2f} steps, std {report['travel']['std']:.2f}, max {report['travel']['max']}")
+            if report["gridlock"]: print("Stopped: gridlock (no car is moving).")
+            if report["crashes"]: print(f"Crashes: {report['crashes']}")
+            if not report["valid"]:
+                print("Invalid run: it did not reach a steady state, so no estimates are given.")
+                raise SystemExit(1)
+        raise SystemExit(0)
+
+    if args.mode == 'replay':
+        if not args.trace: parser.error("replay mode needs --trace")
+        with TraceReader(args.trace) as trace:
+            renderer = TerminalRenderer(viewport=fit_viewport(trace.geometry or DEFAULT_GEOMETRY))
+            pacer = RealTime(args.fps, skip_frames=False) if args.fps > 0 else unpaced
+            try:
+                for i in pacer(range(trace.find_step(args.start), len(trace))):
+                    renderer.render(trace[i])
+                renderer.close()
+            except KeyboardInterrupt:
+                renderer.close()
+                print("\nReplay stopped.")
+        raise SystemExit(0)
+
+    if args.mode == 'network':
+        start = time.perf_counter()
+        with RoadNetwork(args.rows, args.cols, workers=args.workers or 1, seed=args.seed,
+                         pattern=args.pattern, cars=args.cars, concurrent_cars=args.concurrent_cars,
+                         turn_ratio=args.turn_ratio, distribution=args.distribution,
+                         ignore_crashes=args.ignore_crashes, engine=args.engine, plan=plans[0],
+                         arrival_rate=args.arrival_rate, geometry=geometry) as network:
+            stats = network.run(args.ticks)
+        elapsed = time.perf_counter() - start
+        print(f"Network: {args.rows}x{args.cols} {args.pattern}  Ticks: {stats['ticks']}" +
+              ("" if stats["stalled"] else f" ({stats['ticks'] / elapsed:.0f}/s)"))
+        print(f"Cars Started: {stats['created']}  Left network: {stats['exited']}  Still on network: {stats['on_network']}")
+        print(f"Handovers between intersections: {stats['handovers']}  Longest entry queue: {stats['pending_max']}")
+        if stats["crashes"]: print(f"Crashes: {stats['crashes']}")
+        if stats["stalled"]:
+            for row, col, on_grid, waiting in stats["stalled"]:
+                print(f"Stalled: intersection ({row}, {col}) with {on_grid} cars stopped and {waiting} waiting to enter")
+            print(f"Network locked up: no car at those intersections moved for {network.stall_ticks} ticks.")
+            raise SystemExit(1)
+        raise SystemExit(0)
+
+    pattern_class = PATTERNS[args.pattern]
+    concurrent_cars = min(args.concurrent_cars, args.cars)
+
+    metrics = None
+    metrics_file = open(args.metrics, 'w', newline='') if args.metrics else None
+    if metrics_file or args.prometheus:
+        sinks = [CsvSink(metrics_file) if args.metrics.endswith('.csv') else JsonlSink(metrics_file)] if metrics_file else []
+        metrics = Metrics(sinks)
 
     intersection = Intersection(concurrent_cars, args.cars, pattern_class, 
                                 left_turn_percentage=args.turn_ratio, 
                                 distribution_factor=args.distribution,
-                                ignore_crashes=args.ignore_crashes)
+                                ignore_crashes=args.ignore_crashes,
+                                engine=args.engine, timing_plan=plans[0],
+                                arrival_rate=args.arrival_rate, metrics=metrics, geometry=geometry, max_steps=max_steps)
 
+    pacer = RealTime(args.fps) if args.fps > 0 else unpaced
+    intersection.renderer = TerminalRenderer(viewport=fit_viewport(intersection.geometry))
+    intersection.renderer.metrics = metrics
+    record_file = open(args.record, 'wb') if args.record else None
+    frames = TraceWriter(record_file, concurrent_cars)(intersection.run()) if record_file else intersection.run()
     try:
-        while not intersection.is_finished():
-            intersection.cycle()
-        
-        cleanup_steps = 0
-        while len(intersection.cars) > 0:
-            if cleanup_steps > 50: break
-            intersection.update_cars()
-            if not intersection.is_test_mode:
-                intersection.print_state()
-                time.sleep(0.5)
-            cleanup_steps += 1
+        for frame in pacer(frames):
+            intersection.renderer.render(frame)
 
+        intersection.renderer.close()
         if intersection.crashes > 0 and not intersection.ignore_crashes:
             print(f"\nSimulation Halted: A crash occurred after {intersection.steps} steps.")
-        elif intersection.steps >= MAX_STEPS:
-            print(f"\nSimulation finished: Reached step limit of {MAX_STEPS}.")
+        elif intersection.max_steps is not None and intersection.steps >= intersection.max_steps:
+            print(f"\nSimulation finished: Reached step limit of {intersection.max_steps}.")
         else:
             print(f"\nSimulation finished.")
         print(f"Cars Started: {intersection.cars_created}/{intersection.goal_cars}")
@@ -412,4 +2476,10 @@ if __name__ == "__main__":
             print(f"Crashes: {intersection.crashes}")
             
     except KeyboardInterrupt:
-        print("\nSimulation stopped.")
\ No newline at end of file
+        intersection.renderer.close()
+        print("\nSimulation stopped.")
+
+    if record_file: record_file.close()
+    if metrics_file: metrics_file.close()
+    if args.prometheus:
+        with open(args.prometheus, 'w') as f: f.write(metrics.prometheus(intersection))
\ No newline at end of file